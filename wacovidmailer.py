@@ -1,23 +1,47 @@
 #!/usr/bin/env python3
 
 
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pprint import pprint
+from urllib.parse import parse_qs, urlparse
+import argparse
 import codecs
+import concurrent.futures
+import contextlib
+import cProfile
 import csv
+import fcntl
+import functools
+import gzip
+import difflib
+import hashlib
+import html
 import json
 import re
 import lxml.html
+import math
+import multiprocessing
 import os
+import pathlib
+import pstats
 import pytz
 import requests
-import shutil
 import smtplib, ssl
 import sqlite3
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 import traceback
+import tracemalloc
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 waGovUrl = "https://www.healthywa.wa.gov.au/COVID19locations"
@@ -80,22 +104,101 @@ AdminDestAddr = [
     "email1@example.com", 
     "email2@example.com"
 ]
+# The same failure is only alerted again after this many seconds
+adminAlertWindow = 21600
+
+# Static site and JSON/Atom feed publishing
+publishSite = False
+publishDir = "/path/to/public_html"
+publishBaseUrl = "https://exposures.kronicd.net"
+publishFeedLength = 100
+
+# Read-only HTTP query API (run with: wacovidmailer.py serve)
+apiHost = "127.0.0.1"
+apiPort = 8080
+apiCacheEntries = 256
+apiMaxResults = 500
+
+# Run lock and time budget, keep runBudget (seconds) under the cron interval.
+# Each stage gets a share of it, with anything an earlier stage doesn't use
+# carried over to the next.
+runBudget = 780
+httpTimeout = 30
+stageBudgets = {
+    'fetch': 0.45,
+    'ingest': 0.1,
+    'notify': 0.45,
+}
+pendingMaxAttempts = 8
+
+# Alerts are delivered to every destination at once, with at most this many
+# connections per channel, and each delivery is retried deliveryRetries times
+deliveryConcurrency = {
+    'dreamhost': 1,
+    'email': 4,
+    'slack': 4,
+    'discord': 2,
+}
+deliveryRetries = 2
+
+# Sources to skip, and how long to back off a source that keeps failing:
+# after sourceFailureThreshold failures in a row it is skipped for
+# sourceBackoff seconds, doubling each time up to sourceBackoffMax
+disabledSources = ['sheet']
+sourceFailureThreshold = 3
+sourceBackoff = 900
+sourceBackoffMax = 21600
+
+# Changes to include in alerts: exposures that are new (or listed again),
+# exposures whose details have been updated and exposures no longer listed
+reportEvents = ['new', 'updated', 'removed']
+
+# Personalised email alerts for exposures within a radius of a place, places
+# are looked up in the gazetteer of WA suburbs and campuses shipped alongside
+# this script. Add subscribers with: wacovidmailer.py subscribe
+radiusAlerts = False
+gazetteerFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wa_gazetteer.csv")
+defaultRadius = 5
+
+# Probable duplicates of the same site from different sources are merged in
+# alerts, two sites on the same date are duplicates if their names and
+# suburbs/campuses are at least duplicateThreshold similar (0 to 1)
+detectDuplicates = True
+duplicateThreshold = 0.75
+
+# Number of processes used to parse snapshots in replay mode, None for one
+# per CPU
+replayWorkers = None
+
+# Archive of every fetched page, compressed and stored once per distinct page
+archivePages = False
+archiveDir = "/path/to/archive"
+archiveRetentionDays = 90
+archiveMaxBytes = 1024 * 1024 * 1024
 
 ### END OF CONFIGURATION ITEMS
 
 
+# a debug run has a database of its own, a dry run reads the live one
+live_db_file = db_file
 if debug:
     db_file = "exposures-debug.db"
 
 
-def create_connection(db_file):
+def create_connection(db_file, overlay=False):
 
     conn = None
     try:
-        conn = sqlite3.connect(db_file, isolation_level=None)
+        if overlay:
+            conn = openOverlay(db_file)
+        else:
+            conn = sqlite3.connect(db_file, isolation_level=None)
     except Error as e:
         print(f"something went wrong: {e}")
 
+    # WAL lets the query API read while a run is writing
+    conn.execute("PRAGMA journal_mode=WAL;")
+
     # create tables if needed
     query = (
         "SELECT name FROM sqlite_master WHERE type = 'table';"
@@ -111,7 +214,19 @@ def create_connection(db_file):
         'ecu_exposures',
         'uwa_exposures',
         'murdoch_exposures',
-        'curtin_exposures'
+        'curtin_exposures',
+        'pending_deliveries',
+        'run_metrics',
+        'source_health',
+        'delivery_log',
+        'page_archive',
+        'subscribers',
+        'subscriber_geo',
+        'exposure_places',
+        'exposure_geo',
+        'admin_alerts',
+        'exposure_blocks',
+        'exposure_duplicates'
     ]
     
     for table in tables:
@@ -131,7 +246,10 @@ def create_connection(db_file):
                     updated text,
                     advice text,
                     first_seen integer,
-                    last_seen integer
+                    last_seen integer,
+                    content_hash text,
+                    updated_at integer,
+                    removed_at integer
                 );
             """
         elif exposures_table == 'sheet_exposures':
@@ -142,7 +260,10 @@ def create_connection(db_file):
                     location text,
                     suburb text,
                     first_seen integer,
-                    last_seen integer
+                    last_seen integer,
+                    content_hash text,
+                    updated_at integer,
+                    removed_at integer
                 );
             """
         elif exposures_table == 'ecu_exposures':
@@ -155,7 +276,10 @@ def create_connection(db_file):
                     room text,
                     time text,
                     first_seen integer,
-                    last_seen integer
+                    last_seen integer,
+                    content_hash text,
+                    updated_at integer,
+                    removed_at integer
                 );
             """
         elif exposures_table == 'uwa_exposures':
@@ -166,7 +290,10 @@ def create_connection(db_file):
                     location text,
                     time text,
                     first_seen integer,
-                    last_seen integer
+                    last_seen integer,
+                    content_hash text,
+                    updated_at integer,
+                    removed_at integer
                 );
             """
         elif exposures_table == 'murdoch_exposures':
@@ -178,7 +305,10 @@ def create_connection(db_file):
                     location text,
                     time text,
                     first_seen integer,
-                    last_seen integer
+                    last_seen integer,
+                    content_hash text,
+                    updated_at integer,
+                    removed_at integer
                 );
             """
         elif exposures_table == 'curtin_exposures':
@@ -191,797 +321,3257 @@ def create_connection(db_file):
                     location text,
                     time text,
                     first_seen integer,
-                    last_seen integer
+                    last_seen integer,
+                    content_hash text,
+                    updated_at integer,
+                    removed_at integer
+                );
+            """
+        elif exposures_table == 'pending_deliveries':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS pending_deliveries (
+                    id integer PRIMARY KEY,
+                    created integer,
+                    channel text,
+                    destination text,
+                    body text,
+                    attempts integer
+                );
+            """
+        elif exposures_table == 'run_metrics':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS run_metrics (
+                    id integer PRIMARY KEY,
+                    run integer,
+                    stage text,
+                    duration real,
+                    budget real,
+                    overrun integer
+                );
+            """
+        elif exposures_table == 'source_health':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS source_health (
+                    source text PRIMARY KEY,
+                    consecutive_failures integer,
+                    last_success integer,
+                    last_failure integer,
+                    last_error text,
+                    next_attempt integer
+                );
+            """
+        elif exposures_table == 'delivery_log':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS delivery_log (
+                    id integer PRIMARY KEY,
+                    run integer,
+                    channel text,
+                    destination text,
+                    status text,
+                    latency real,
+                    retries integer,
+                    error text
+                );
+            """
+        elif exposures_table == 'page_archive':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS page_archive (
+                    id integer PRIMARY KEY,
+                    source text,
+                    fetched_at integer,
+                    status integer,
+                    hash text,
+                    size integer
+                );
+            """
+        elif exposures_table == 'admin_alerts':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS admin_alerts (
+                    fingerprint text PRIMARY KEY,
+                    source text,
+                    kind text,
+                    message text,
+                    details text,
+                    first_seen integer,
+                    last_seen integer,
+                    occurrences integer,
+                    last_notified integer,
+                    resolved_at integer
+                );
+            """
+        elif exposures_table == 'exposure_blocks':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS exposure_blocks (
+                    id integer PRIMARY KEY,
+                    block text,
+                    source text,
+                    exposure_id integer,
+                    canonical text,
+                    numbers text,
+                    time integer
+                );
+            """
+        elif exposures_table == 'exposure_duplicates':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS exposure_duplicates (
+                    id integer PRIMARY KEY,
+                    source text,
+                    exposure_id integer,
+                    duplicate_source text,
+                    duplicate_id integer,
+                    score real
+                );
+            """
+        elif exposures_table == 'subscribers':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS subscribers (
+                    id integer PRIMARY KEY,
+                    email text,
+                    place text,
+                    latitude real,
+                    longitude real,
+                    radius real,
+                    created integer
+                );
+            """
+        elif exposures_table == 'subscriber_geo':
+            # the area each subscriber's radius covers, as a bounding box
+            table_create = """
+                CREATE VIRTUAL TABLE IF NOT EXISTS subscriber_geo USING rtree (
+                    id,
+                    min_lat, max_lat,
+                    min_lon, max_lon
+                );
+            """
+        elif exposures_table == 'exposure_places':
+            table_create = """
+                CREATE TABLE IF NOT EXISTS exposure_places (
+                    id integer PRIMARY KEY,
+                    source text,
+                    exposure_id integer,
+                    place text,
+                    latitude real,
+                    longitude real
+                );
+            """
+        elif exposures_table == 'exposure_geo':
+            table_create = """
+                CREATE VIRTUAL TABLE IF NOT EXISTS exposure_geo USING rtree (
+                    id,
+                    min_lat, max_lat,
+                    min_lon, max_lon
                 );
             """
         
         conn.execute(table_create)
         conn.commit()
 
-    return conn
-
-
-def sendEmails(body):
+    conn.execute("CREATE INDEX IF NOT EXISTS page_archive_hash ON page_archive (hash);")
+    conn.execute("CREATE INDEX IF NOT EXISTS subscribers_email ON subscribers (email);")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS exposure_places_exposure ON exposure_places (source, exposure_id);")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS exposure_blocks_entry ON exposure_blocks (block, source, exposure_id);")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS exposure_duplicates_pair ON exposure_duplicates (source, exposure_id, duplicate_source, duplicate_id);")
 
-    for destEmail in destAddr:
+    # exposures are looked up by all of their fields
+    for source in exposure_sources:
+        fields = ", ".join(exposure_sources[source]['fields'])
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {source}_exposures_lookup ON {source}_exposures ({fields});")
 
-        message = f"""To: {destEmail}
-From: {fromAddr}
-Reply-To: {replyAddr}
-Subject: {subjLine}
+    # columns added since the exposures tables were first created
+    for source in exposure_sources:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({source}_exposures);")]
+        if 'removed_at' not in columns:
+            migrateExposures(conn, source)
 
+    return conn
 
-{body}.""".encode("ascii", "replace")
 
-        try:
-            context = ssl.create_default_context()
+def migrateExposures(conn, source):
 
-            with smtplib.SMTP_SSL(smtpServ, smtpPort, context=context) as server:
-                server.sendmail(fromAddr, destEmail, message)
-                print(f"Email sent to {destEmail}")
-        except smtplib.SMTPException as e:
-            print("SMTP error occurred: " + str(e))
+    # add change tracking to a table from before rows were matched on their
+    # key fields
+    table = f"{source}_exposures"
+    key = exposure_sources[source]['key']
 
+    print(f"Adding change tracking to {table}")
 
-def sendAdminAlert(errorMsg):
+    conn.execute("BEGIN;")
 
-    if(adminAlerts):
-        for adminDestEmail in AdminDestAddr:
+    for column in ['content_hash text', 'updated_at integer', 'removed_at integer']:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column};")
 
-            message = f"""To: {AdminDestAddr}
-From: {adminFromAddr}
-Reply-To: {AdminReplyAddr}
-Subject: {AdminSubjLine}
+    for row in fetch_dicts(conn, f"SELECT * FROM {table};"):
+        conn.execute(f"UPDATE {table} SET content_hash = ? WHERE id = ?;", (exposure_contentHash(source, row), row['id']))
 
-{errorMsg}.""".encode("ascii", "replace")
+    # an edit to a row used to be stored as a new row, so only the newest row
+    # for each key is still current
+    query = f"""UPDATE {table} SET removed_at = last_seen WHERE
+                id NOT IN (SELECT max(id) FROM {table} GROUP BY {', '.join(key)});"""
+    conn.execute(query)
 
-            try:
-                with smtplib.SMTP(adminSmtpServ, adminSmtpPort) as server:
-                    server.starttls()
-                    server.ehlo()
-                    server.login(adminSmtpUser, adminSmtpPass)
-                    server.sendmail(adminFromAddr, adminDestEmail, message)
-
-                    print(f"Email sent to {adminDestEmail}")
-            except smtplib.SMTPException as e:
-                print("SMTP error occurred: " + str(e))
-    else:
-        print("Admin alerts disabled")
-        print(errorMsg)
+    # and anything missing from the latest scrape has already been removed
+    query = f"""UPDATE {table} SET removed_at = last_seen WHERE
+                removed_at IS NULL
+                AND last_seen < (SELECT max(last_seen) FROM {table});"""
+    conn.execute(query)
 
-def post_message_to_slack(text, blocks=None):
+    conn.execute("COMMIT;")
 
-    for webhook_url in webhook_urls:
-        slack_data = {"text": text}
 
-        response = requests.post(
-            webhook_url,
-            data=json.dumps(slack_data),
-            headers={"Content-Type": "application/json"},
-        )
+def fetch_dicts(conn, query, args=()):
 
-        if response.status_code != 200:
-            raise ValueError(
-                "Request to slack returned an error %s, the response is:\n%s"
-                % (response.status_code, response.text)
-            )
+    result = conn.execute(query, args)
+    columns = [column[0] for column in result.description]
 
-        print("Slack sent")
+    return [dict(zip(columns, row)) for row in result.fetchall()]
 
 
-def chunky_alerts(text, delimeter="\n\n", max_length=1990):
-    i = 0
-    while i < len(text):
-        # Note: if the last chunk is less than max_length, it will be included
-        if i + max_length > len(text):
-            yield text[i:]
-            break
+def create_backup(conn, backup_file):
 
-        nearest_delim = text[i:i+max_length][::-1].index(delimeter) # Calculate the nearest delimiter index, by reversing the string and finding the first occurence of the delimeter
-        yield text[i:i+max_length-nearest_delim -len(delimeter)] # we don't need the additional delim chars here
-        i += max_length - nearest_delim # we need them here, so we don't end up including a bunch of line breaks
+    # use sqlite's backup API rather than copying the file, as recent writes
+    # may still be sitting in the WAL
+    backup = sqlite3.connect(backup_file)
+    conn.backup(backup)
+    backup.close()
 
 
-def post_message_to_discord(text, blocks=None):
+def restore_backup(conn, backup_file, keep=()):
 
-    for discord_webhook_url in discord_webhook_urls:
+    # copy the backup back in through sqlite, so the WAL and any readers
+    # stay consistent, then remove it. Tables in keep are carried over as
+    # they are now rather than rolled back.
+    kept = {table: conn.execute(f"SELECT * FROM {table};").fetchall() for table in keep}
 
-        # Discord doesn't let us post more than 2000 characters at a time
-        # so we need to split and make individual posts every 2 seconds to avoid rate limits.
-        # This may spam notifications depending on your server settings
-        alert_total = len(list(chunky_alerts(text)))
-        for alert_number, alert in enumerate(chunky_alerts(text)):
-            discord_data = {"content": alert}
+    backup = sqlite3.connect(backup_file)
+    backup.backup(conn)
+    backup.close()
+    os.remove(backup_file)
 
-            response = requests.post(
-                discord_webhook_url,
-                data=json.dumps(discord_data),
-                headers={"Content-Type": "application/json"},
-            )
+    conn.execute("BEGIN;")
+    for table, rows in kept.items():
+        conn.execute(f"DELETE FROM {table};")
+        for row in rows:
+            conn.execute(f"INSERT INTO {table} VALUES ({','.join('?' * len(row))});", row)
+    conn.execute("COMMIT;")
 
-            if response.status_code != 200|204: #Discord returns 204 no data on success
-                raise ValueError(
-                    "Request to discord returned an error %s, the response is:\n%s"
-                    % (response.status_code, response.text)
-                )
 
-            print("Discord sent %s of %s" % (alert_number, alert_total))
-            time.sleep(2)        
+def openOverlay(db_file):
 
+    # copy the database into memory through a read-only connection, so a run
+    # can read and write the copy while the file itself is never opened for
+    # writing. The copy is thrown away when the connection is closed.
+    if not os.path.exists(db_file):
+        raise Exception(f"{db_file} does not exist")
 
-def sendDhAnnounce(comms):
+    source = api_openReadOnly(db_file)
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    source.backup(conn)
+    source.close()
 
-    url = "https://api.dreamhost.com/"
+    return conn
 
-    bodyParams = {
-        "key": "somevalue",
-    }
-    data = {
-        "key": apiKey,
-        "cmd": "announcement_list-post_announcement",
-        "listname": listName,
-        "domain": listDomain,
-        "subject": subjLine,
-        "message": comms,
-        "charset": "utf-8",
-        "type": "text",
-        "duplicate_ok": "1",
-    }
 
-    x = requests.post(url, data=data)
+def acquireRunLock(lock_file):
 
-    print(x.text)
-    return x.status_code
+    # held for the life of the process, so a run that overlaps a slow one
+    # bails out instead of racing it on the DB and its backup
+    lock = open(lock_file, "w")
 
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
 
-def html_cleanString(s):
+    return lock
 
-    try:
-        s = str(lxml.html.fromstring(s).text_content())
-    except:
-        pass
 
-    s = s.strip().replace('\r','').replace('\n','').rstrip(',')
+class BudgetExceeded(Exception):
+    pass
 
-    return s
 
-def wahealth_GetLocations():
+class RunBudget:
 
-    req = requests.get(waGovUrl)
+    def __init__(self, seconds, shares):
+        self.seconds = seconds
+        self.shares = shares
+        self.start()
 
-    if req.status_code != 200:
-        print(f"Failed to fetch page: {req.reason}")
-        raise Exception("reqest_not_ok")
+    def start(self):
+        self.started = time.monotonic()
+        self.timings = []
+        self.stage = None
+        self.stage_started = self.started
+        self.stage_deadline = self.started + self.seconds
+        self.stage_overrun = False
 
-    doc = lxml.html.fromstring(req.content)
+    def begin(self, stage):
+        self.end()
 
-    sites_table = doc.xpath('//table[@id="locationTable"]')[0][1]
-    rows = sites_table.xpath(".//tr")
+        # a stage may run until its cumulative share of the budget is used up,
+        # stages without a share may use whatever is left
+        share = 0
+        for name, fraction in self.shares.items():
+            share += fraction
+            if name == stage:
+                break
+        else:
+            share = 1
 
-    # check for proper header
-    header = doc.xpath('//table[@id="locationTable"]')[0][0]
-    headerRows = header.xpath(".//th")
+        self.stage = stage
+        self.stage_started = time.monotonic()
+        self.stage_deadline = self.started + self.seconds * min(share, 1)
+        self.stage_overrun = False
 
-    if (headerRows[0].text_content() == 'Exposure date & time' and 
-    headerRows[1].text_content() == 'Suburb' and
-    headerRows[2].text_content() == 'Location' and
-    headerRows[3].text_content() == 'Date updated' and
-    headerRows[4].text_content() == 'Health advice'):
-        pass
-    else:
-        raise Exception("WAHealth Failed - Parsing page failure")
+    def end(self):
+        if self.stage is None:
+            return
 
-    if len(rows) < 1:
-        print(f"found no data")
-        raise Exception("table_parse_fail")
+        now = time.monotonic()
+        self.timings.append({
+            'stage': self.stage,
+            'duration': now - self.stage_started,
+            'budget': max(0, self.stage_deadline - self.stage_started),
+            'overrun': self.stage_overrun or now > self.stage_deadline,
+        })
+        self.stage = None
 
-    return rows
+    def remaining(self):
+        return max(0, self.stage_deadline - time.monotonic())
 
+    def expired(self):
+        if self.remaining() > 0:
+            return False
 
-def wahealth_cleanString(location):
+        self.stage_overrun = True
+        return True
 
-    newLoc = ""
-    location = location.replace("\xa0", "")
-    for line in location.split("\n"):
-        newLoc = newLoc + line.lstrip().rstrip() + ", "
-    return newLoc.rstrip(", ").lstrip(", ").replace(", , ", "; ").replace(" , ", " ").rstrip("\r\n")
+    def timeout(self):
 
+        # note requests applies this per connect/read rather than to the whole
+        # request, which is close enough for keeping a run inside its window
+        if self.expired():
+            raise BudgetExceeded(f"Out of time in the {self.stage} stage")
 
-def wahealth_buildDetails(exposure):
-    exposure_details = f"""Date and Time: {exposure['datentime']}
-Suburb: {exposure['suburb']}
-Location: {exposure['location']}
-Updated: {exposure['updated']}
-Advice: {exposure['advice']}\n\n"""
-    
-    return exposure_details
+        return min(httpTimeout, self.remaining())
 
-def wahealth_filterExposures(exposures):
 
-    # examine each exposure
-    # if it is in the DB already, get the id and update last seen
-    # if it is not in the DB: create the first seen date and make id 'None'
-    alerts = []
-    for exposure in exposures:
-        
-        record = {}
+run_budget = RunBudget(runBudget, stageBudgets)
 
-        record['datentime'] = wahealth_cleanString(exposure[1].text_content())
-        record['suburb'] = wahealth_cleanString(exposure[2].text_content())
-        record['location'] = wahealth_cleanString(exposure[3].text_content())
-        record['updated'] = wahealth_cleanString(exposure[4].text_content())
-        record['advice'] = wahealth_cleanString(exposure[5].text_content())
-        record['last_seen'] = unix_timestamp
-
-        query = """SELECT count(id), coalesce(id, 0) FROM wahealth_exposures WHERE 
-                    datentime = ? 
-                    AND suburb = ?
-                    AND location = ?
-                    AND updated = ?
-                    AND advice = ?;"""
-
-        args = (record['datentime'], record['suburb'], record['location'], record['updated'], record['advice'])
-        result = dbconn.execute(query, args)
-        
-        id = result.fetchone()
-        if id[0] > 0:
-            record['id'] = id[1]
-        else:
-            record['id'] = None
-            record['first_seen'] = unix_timestamp
-        
-        alerts.append(record)
 
-    return alerts
+class StageProfiler:
 
+    # profiles each stage of a run with cProfile and tracemalloc, and samples
+    # the stack of every thread that's inside a stage for a flamegraph.
+    # cProfile only profiles the thread it's started on, and only one can run
+    # at a time, so stages on worker threads (deliveries) are only timed and
+    # sampled.
 
-def sheet_GetLocations():
+    sampleInterval = 0.005
 
-    # Consumer: https://docs.google.com/spreadsheets/d/1-U8Ea9o9bnST5pzckC8lzwNNK_jO6kIVUAi5Uu_-Ltc/edit?fbclid=IwAR3EaVvU0di14R6zqqfFP7sDLCwPOYax_SjMcDlmV2D2leqKGRAROCInpj4#gid=1427159313
-    # Detailed/Admin: https://docs.google.com/spreadsheets/d/12fN17qFR8ruSk2yf29CR1S6xZMs_nve2ww_6FJk7__8/edit#gid=0
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.summary = {}
+        self.active = {}
+        self.samples = {}
 
-    sheet_id = "1-U8Ea9o9bnST5pzckC8lzwNNK_jO6kIVUAi5Uu_-Ltc"
-    sheet_name = "All%20Locations"
-    url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq?tqx=out:csv&sheet={sheet_name}"
+        os.makedirs(directory, exist_ok=True)
+        tracemalloc.start()
 
-    res = requests.get(url)
-    contents = codecs.decode(res.content, 'UTF-8')
-    contents = contents.replace('"",','')
-    split = contents.splitlines()
-    reader = csv.reader(split)
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
 
-    sheetExposures = []
+    def filename(self, name, suffix):
+        return os.path.join(self.directory, re.sub(r"[^A-Za-z0-9_-]", "-", name) + suffix)
 
-    for record in reader:
-        exposure = {}
+    @contextlib.contextmanager
+    def stage(self, name):
+        main = threading.current_thread() is threading.main_thread()
+        stack = self.active.setdefault(threading.get_ident(), [])
+        frame = {'name': name, 'profile': None, 'peak': 0, 'start_memory': 0, 'overhead': 0}
 
-        if record[4] == "Business":
-            exposure['datentime'] = html_cleanString(record[2])
-            exposure['suburb'] = html_cleanString(record[1])
-            exposure['location'] = html_cleanString(record[0]) + " " + html_cleanString(record[3])
-            exposure['last_seen'] = unix_timestamp
-
-            query = """SELECT count(id), coalesce(id, 0) FROM sheet_exposures WHERE
-                        datentime = ?
-                        AND suburb = ?
-                        AND location = ?;"""
-            
-            args = (exposure['datentime'], exposure['suburb'], exposure['location'])
-            result = dbconn.execute(query, args)
-
-            id = result.fetchone()
-            if id[0] > 0:
-                exposure['id'] = id[1]
-            else:
-                exposure['id'] = None
-                exposure['first_seen'] = unix_timestamp
+        if main:
+            # pause the enclosing stage so time isn't counted twice, and
+            # remember its peak before resetting it for this one
+            if len(stack) > 0:
+                stack[-1]['profile'].disable()
+                stack[-1]['peak'] = max(stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
 
-            sheetExposures.append(exposure)
+            tracemalloc.reset_peak()
+            frame['start_memory'] = tracemalloc.get_traced_memory()[0]
+            frame['profile'] = cProfile.Profile()
 
-    if(len(sheetExposures) < 1):
-        raise Exception("Sheets Failed - Zero records retrieved")
+        stack.append(frame)
+        started = time.perf_counter()
 
-    return sheetExposures
+        if frame['profile'] is not None:
+            frame['profile'].enable()
 
+        try:
+            yield
+        finally:
+            if frame['profile'] is not None:
+                frame['profile'].disable()
 
+            finished = time.perf_counter()
+            wall = finished - started - frame['overhead']
+            stack.pop()
 
-def sheet_buildDetails(exposure):
-    exposure_details = f"""Date and Time: {exposure['datentime']}
-Suburb: {exposure['suburb']}
-Location: {exposure['location']}\n\n"""
-    
-    return exposure_details
+            peak = 0
+            if main:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                tracemalloc.take_snapshot().dump(self.filename(name, ".tracemalloc"))
 
+                # don't let the snapshot count towards the enclosing stage
+                tracemalloc.reset_peak()
 
-def ecu_GetLocations():
-    ecu_url = 'https://www.ecu.edu.au/covid-19/advice-for-staff'
+            with self.lock:
+                summary = self.summary.setdefault(name, {'calls': 0, 'wall': 0, 'peak': 0, 'growth': 0})
+                summary['calls'] += 1
+                summary['wall'] += wall
+                summary['peak'] = max(summary['peak'], peak)
+                summary['growth'] = max(summary['growth'], peak - frame['start_memory'])
 
+                if frame['profile'] is not None:
+                    if name in self.stats:
+                        self.stats[name].add(frame['profile'])
+                    else:
+                        self.stats[name] = pstats.Stats(frame['profile'])
 
-    req = requests.get(ecu_url)
+            if main and len(stack) > 0:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+                stack[-1]['overhead'] += frame['overhead'] + time.perf_counter() - finished
+                stack[-1]['profile'].enable()
 
-    if req.status_code != 200:
-        print(f"Failed to fetch page: {req.reason}")
-        raise Exception("reqest_not_ok")
+    def sample(self):
+        me = threading.get_ident()
 
-    doc = lxml.html.fromstring(req.content)
+        while self.running:
+            time.sleep(self.sampleInterval)
 
-    container = doc.xpath('//div[@id="accordion-01e803ff84807e270adaddf7ade2fa91035b560d"]')[0]
-    tables = container.xpath(".//table")
+            for thread_id, frame in sys._current_frames().items():
+                stages = self.active.get(thread_id)
+                if thread_id == me or not stages:
+                    continue
 
-    outRows = []
+                try:
+                    names = [stages[-1]['name']]
+                except IndexError:
+                    continue
 
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
 
-    for table in tables:
-        campus = html_cleanString(table.getparent().getparent().getparent().getparent()[0].text_content().strip())
-        rows = table.xpath('./tr')
+                stack = ";".join(names + calls[::-1])
+                self.samples[stack] = self.samples.get(stack, 0) + 1
 
-        for row in rows:
-            record = {}
+    def finish(self):
+        self.running = False
+        self.sampler.join()
+        tracemalloc.stop()
 
-            record['campus'] = campus
-            record['date'] = html_cleanString(row[0].text_content().strip())
-            record['time'] = html_cleanString(row[1].text_content().strip())
-            record['building'] = html_cleanString(row[2].text_content().strip())
-            record['room'] = html_cleanString(row[3].text_content().strip())
-            record['last_seen'] = unix_timestamp
-
-            query = """SELECT count(id), coalesce(id, 0) FROM ecu_exposures WHERE
-                        campus = ?
-                        AND date = ?
-                        AND time = ?
-                        AND building = ?
-                        AND room = ?;"""
-            
-            args = (record['campus'], record['date'], record['time'], record['building'], record['room'])
-            result = dbconn.execute(query, args)
-
-            id = result.fetchone()
-            if id[0] > 0:
-                record['id'] = id[1]
-            else:
-                record['id'] = None
-                record['first_seen'] = unix_timestamp
+        for name, stats in self.stats.items():
+            stats.dump_stats(self.filename(name, ".pstats"))
 
-            outRows.append(record)
+        with open(os.path.join(self.directory, "stacks.collapsed"), "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
 
-    for table in tables:
-        header = table.xpath('.//thead')[0][0]
+        lines = [f"{'stage':<24} {'calls':>6} {'wall':>10} {'peak KiB':>12} {'growth KiB':>12}"]
+        for name, summary in self.summary.items():
+            lines.append(f"{name:<24} {summary['calls']:>6} {summary['wall']:>9.3f}s {summary['peak'] / 1024:>12.0f} {summary['growth'] / 1024:>12.0f}")
 
-        if (header[0].text_content().strip() == 'Date' and
-            header[1].text_content().strip() == 'Time' and
-            header[2].text_content().strip() == 'Building' and
-            header[3].text_content().strip() == 'Room'):
-            pass
-        else:
-            raise Exception("ECU Failed - Parsing page failure")
+        with open(os.path.join(self.directory, "summary.txt"), "w") as f:
+            f.write("\n".join(lines) + "\n")
 
-    return outRows
+        print("\n".join(lines))
+        print(f"Profile written to {self.directory}")
 
 
-def ecu_buildDetails(exposure):
-    exposure_details = f"""Date: {exposure['date']}
-Time: {exposure['time']}
-Campus: {exposure['campus']}
-Building: {exposure['building']}
-Room: {exposure['room']}\n\n"""
-    
-    return exposure_details
+profiler = None
+no_profile = contextlib.nullcontext()
 
 
-def uwa_GetLocations():
-    uwa_url = 'https://www.uwa.edu.au/covid-19-faq/Home'
+# set by --dry-run to where the digest goes, '-' for stdout
+dry_run = None
 
 
-    req = requests.get(uwa_url)
+def profileStage(name):
 
-    if req.status_code != 200:
-        print(f"Failed to fetch page: {req.reason}")
-        raise Exception("reqest_not_ok")
+    # when profiling is off this is all a stage costs
+    if profiler is None:
+        return no_profile
 
-    doc = lxml.html.fromstring(req.content)
+    return profiler.stage(name)
 
-    rows = doc.xpath('//div/table/tbody/tr')
 
-    header = rows.pop(0)
+def recordRunMetrics(conn):
 
-    outRows = []
+    run_budget.end()
 
-    for row in rows:
-        record = {}
+    for timing in run_budget.timings:
+        query = """INSERT INTO run_metrics (run, stage, duration, budget, overrun)
+                    VALUES (?,?,?,?,?) """
 
-        # kludge as there are empty rows with a single cell sometimes :(
-        if(len(row) < 3):
-            return ""
+        args = (unix_timestamp, timing['stage'], timing['duration'], timing['budget'], int(timing['overrun']))
+        conn.execute(query, args)
 
-        record['date'] = html_cleanString(row[0].text_content().strip())
-        record['location'] = html_cleanString(row[1].text_content().strip())
-        record['time'] = html_cleanString(row[2].text_content().strip())
-        record['last_seen'] = unix_timestamp
+        if timing['overrun']:
+            print(f"Stage {timing['stage']} overran its budget: {timing['duration']:.1f}s of {timing['budget']:.1f}s")
 
-        query = """SELECT count(id), coalesce(id, 0) FROM uwa_exposures WHERE
-                    date = ?
-                    AND time = ?
-                    AND location = ?;"""
-        
-        args = (record['date'], record['time'], record['location'])
-        result = dbconn.execute(query, args)
 
-        id = result.fetchone()
-        if id[0] > 0:
-            record['id'] = id[1]
-        else:
-            record['id'] = None
-            record['first_seen'] = unix_timestamp
+def sendEmail(destEmail, body):
 
-        outRows.append(record)
+    message = f"""To: {destEmail}
+From: {fromAddr}
+Reply-To: {replyAddr}
+Subject: {subjLine}
 
 
-    if (header[0].text_content().strip() == 'Date' and
-        header[1].text_content().strip() == 'Location' and
-        header[2].text_content().strip() == 'Time'):
-        pass
-    else:
-        raise Exception("UWA Failed - Parsing page failure")
+{body}.""".encode("ascii", "replace")
 
-    return outRows
+    try:
+        context = ssl.create_default_context()
 
+        with smtplib.SMTP_SSL(smtpServ, smtpPort, context=context, timeout=run_budget.timeout()) as server:
+            server.sendmail(fromAddr, destEmail, message)
+            print(f"Email sent to {destEmail}")
+            return True
+    except smtplib.SMTPException as e:
+        print("SMTP error occurred: " + str(e))
 
-def uwa_buildDetails(exposure):
-    exposure_details = f"""Date: {exposure['date']}
-Time: {exposure['time']}
-Location: {exposure['location']}\n\n"""
-    
-    return exposure_details
+    return False
 
 
-def murdoch_GetLocations():
-    murdoch_url = 'https://www.murdoch.edu.au/notices/covid-19-advice'
+def sendAdminAlert(body):
 
+    # returns whether the alert was dealt with, so it isn't marked as sent
+    # when it wasn't
+    if dry_run is not None:
+        print("Dry run, admin alert not sent")
+        print(body)
+    elif(adminAlerts):
+        message = f"""To: {", ".join(AdminDestAddr)}
+From: {adminFromAddr}
+Reply-To: {AdminReplyAddr}
+Subject: {AdminSubjLine}
 
-    req = requests.get(murdoch_url)
+{body}""".encode("ascii", "replace")
 
-    if req.status_code != 200:
+        # one session for every admin
+        try:
+            with smtplib.SMTP(adminSmtpServ, adminSmtpPort, timeout=httpTimeout) as server:
+                server.starttls()
+                server.ehlo()
+                server.login(adminSmtpUser, adminSmtpPass)
+                server.sendmail(adminFromAddr, AdminDestAddr, message)
+
+                print(f"Admin alert sent to {', '.join(AdminDestAddr)}")
+        except (smtplib.SMTPException, OSError) as e:
+            print("SMTP error occurred: " + str(e))
+            return False
+    else:
+        print("Admin alerts disabled")
+        print(body)
+
+    return True
+
+
+# admin alerts raised and things that have recovered during this run, they're
+# kept here rather than in the DB until flushAdminAlerts so a rolled back run
+# doesn't lose them
+admin_alerts = []
+admin_recovered = set()
+
+
+def adminAlert(source, kind, message, details=""):
+
+    print(f"{source}: {kind}: {message}")
+    admin_alerts.append({'source': source, 'kind': kind, 'message': message, 'details': details})
+
+
+def adminAlert_recovered(source):
+
+    admin_recovered.add(source)
+
+
+def adminAlert_time(timestamp):
+    return datetime.fromtimestamp(timestamp, pytz.timezone("Australia/Perth")).strftime("%d/%m/%Y %H:%M:%S")
+
+
+def adminAlert_record(conn, alert):
+
+    # the same failure happening again is the same alert, so it's keyed on a
+    # fingerprint of where it came from, what it was and what it said
+    fingerprint = hashlib.sha1("\0".join([alert['source'], alert['kind'], alert['message']]).encode("utf-8")).hexdigest()
+
+    query = """INSERT OR IGNORE INTO admin_alerts (fingerprint, source, kind, message, first_seen, occurrences)
+                VALUES (?,?,?,?,?,0) """
+    conn.execute(query, (fingerprint, alert['source'], alert['kind'], alert['message'], unix_timestamp))
+
+    # one that comes back after being resolved starts again from scratch
+    query = """UPDATE admin_alerts SET first_seen = ?, occurrences = 0, last_notified = NULL, resolved_at = NULL
+                WHERE fingerprint = ? AND resolved_at IS NOT NULL;"""
+    conn.execute(query, (unix_timestamp, fingerprint))
+
+    query = """UPDATE admin_alerts SET last_seen = ?, occurrences = occurrences + 1, details = ?
+                WHERE fingerprint = ?;"""
+    conn.execute(query, (unix_timestamp, alert['details'], fingerprint))
+
+    return fingerprint
+
+
+def adminAlert_resolve(conn, source):
+
+    conn.execute("UPDATE admin_alerts SET resolved_at = ? WHERE source = ? AND resolved_at IS NULL;", (unix_timestamp, source))
+
+
+def flushAdminAlerts(conn):
+
+    # record this run's alerts, then send one digest of the ones that haven't
+    # been sent within adminAlertWindow along with anything that has recovered
+    for alert in admin_alerts:
+        adminAlert_record(conn, alert)
+
+    query = """SELECT * FROM admin_alerts WHERE
+                resolved_at IS NULL
+                AND last_seen = ?
+                AND (last_notified IS NULL OR last_notified <= ?)
+                ORDER BY source, first_seen;"""
+    failing = fetch_dicts(conn, query, (unix_timestamp, unix_timestamp - adminAlertWindow))
+
+    recovered = []
+    for source in sorted(admin_recovered):
+        query = "SELECT * FROM admin_alerts WHERE source = ? AND resolved_at IS NULL;"
+        resolved = fetch_dicts(conn, query, (source,))
+        if len(resolved) < 1:
+            continue
+
+        # nobody needs telling about a recovery from something they never
+        # heard about, otherwise it stays open until the notice has been sent
+        if any(alert['last_notified'] is not None for alert in resolved):
+            recovered.append((source, min(alert['first_seen'] for alert in resolved), sum(alert['occurrences'] for alert in resolved)))
+        else:
+            adminAlert_resolve(conn, source)
+
+    admin_alerts.clear()
+    admin_recovered.clear()
+
+    if len(failing) < 1 and len(recovered) < 1:
+        return
+
+    body = ""
+
+    if len(failing) > 0:
+        body += "Please investigate:\n\n"
+
+        for alert in failing:
+            body += f"""{alert['source']}: {alert['kind']}: {alert['message']}
+First seen: {adminAlert_time(alert['first_seen'])}
+Last seen: {adminAlert_time(alert['last_seen'])}
+Occurrences: {alert['occurrences']}
+{alert['details']}
+"""
+            if alert['details']:
+                body += "\n"
+
+    for source, first_seen, occurrences in recovered:
+        body += f"Recovered: {source} is working again after failing {occurrences} times since {adminAlert_time(first_seen)}\n"
+
+    if not sendAdminAlert(body.rstrip("\n")):
+        return
+
+    for source, first_seen, occurrences in recovered:
+        adminAlert_resolve(conn, source)
+
+    if len(failing) > 0:
+        fingerprints = [alert['fingerprint'] for alert in failing]
+        query = f"UPDATE admin_alerts SET last_notified = ? WHERE fingerprint IN ({','.join('?' * len(fingerprints))});"
+        conn.execute(query, [unix_timestamp] + fingerprints)
+
+
+def post_to_slack(webhook_url, text):
+
+    slack_data = {"text": text}
+
+    response = requests.post(
+        webhook_url,
+        data=json.dumps(slack_data),
+        headers={"Content-Type": "application/json"},
+        timeout=run_budget.timeout(),
+    )
+
+    if response.status_code != 200:
+        raise ValueError(
+            "Request to slack returned an error %s, the response is:\n%s"
+            % (response.status_code, response.text)
+        )
+
+    print("Slack sent")
+
+
+def chunky_alerts(text, delimeter="\n\n", max_length=1990):
+    i = 0
+    while i < len(text):
+        # Note: if the last chunk is less than max_length, it will be included
+        if i + max_length > len(text):
+            yield text[i:]
+            break
+
+        nearest_delim = text[i:i+max_length][::-1].index(delimeter) # Calculate the nearest delimiter index, by reversing the string and finding the first occurence of the delimeter
+        yield text[i:i+max_length-nearest_delim -len(delimeter)] # we don't need the additional delim chars here
+        i += max_length - nearest_delim # we need them here, so we don't end up including a bunch of line breaks
+
+
+class PartialDelivery(Exception):
+
+    # raised when part of a message went out before an error, so a retry
+    # only sends the rest
+    def __init__(self, remainder, error):
+        super().__init__(str(error))
+        self.remainder = remainder
+
+
+def post_to_discord(discord_webhook_url, text):
+
+    # Discord doesn't let us post more than 2000 characters at a time
+    # so we need to split and make individual posts every 2 seconds to avoid rate limits.
+    # This may spam notifications depending on your server settings
+    alerts = list(chunky_alerts(text))
+    alert_total = len(alerts)
+    for alert_number, alert in enumerate(alerts):
+
+        # hand back whatever we can't get through so it can go in the next run
+        # rather than holding this one up
+        if run_budget.remaining() < 2:
+            return "\n\n".join(alerts[alert_number:])
+
+        discord_data = {"content": alert}
+
+        try:
+            response = requests.post(
+                discord_webhook_url,
+                data=json.dumps(discord_data),
+                headers={"Content-Type": "application/json"},
+                timeout=run_budget.timeout(),
+            )
+
+            if response.status_code != 200|204: #Discord returns 204 no data on success
+                raise ValueError(
+                    "Request to discord returned an error %s, the response is:\n%s"
+                    % (response.status_code, response.text)
+                )
+        except (requests.RequestException, ValueError) as e:
+            if alert_number > 0:
+                raise PartialDelivery("\n\n".join(alerts[alert_number:]), e)
+            raise
+
+        print("Discord sent %s of %s" % (alert_number, alert_total))
+        time.sleep(2)        
+
+    return None
+
+
+def sendDhAnnounce(comms):
+
+    url = "https://api.dreamhost.com/"
+
+    bodyParams = {
+        "key": "somevalue",
+    }
+    data = {
+        "key": apiKey,
+        "cmd": "announcement_list-post_announcement",
+        "listname": listName,
+        "domain": listDomain,
+        "subject": subjLine,
+        "message": comms,
+        "charset": "utf-8",
+        "type": "text",
+        "duplicate_ok": "1",
+    }
+
+    x = requests.post(url, data=data, timeout=run_budget.timeout())
+
+    print(x.text)
+    return x.status_code
+
+
+def deliverTo(channel, destination, body):
+
+    # returns whatever part of body couldn't be delivered in time
+    if channel == 'email':
+        if not sendEmail(destination, body):
+            raise smtplib.SMTPException(f"Unable to send email to {destination}")
+    elif channel == 'slack':
+        post_to_slack(destination, body)
+    elif channel == 'discord':
+        return post_to_discord(destination, body)
+    elif channel == 'dreamhost':
+        status = sendDhAnnounce(body)
+        if status != 200:
+            raise ValueError(f"Dreamhost announce returned {status}")
+
+    return None
+
+
+def deliveryJob(job):
+
+    result = dict(job)
+    result['status'] = 'deferred'
+    result['latency'] = 0
+    result['retries'] = 0
+    result['error'] = None
+
+    with profileStage(f"deliver:{job['channel']}"):
+        started = time.monotonic()
+
+        for attempt in range(deliveryRetries + 1):
+
+            if run_budget.expired():
+                result['status'] = 'deferred'
+                break
+
+            try:
+                remainder = deliverTo(result['channel'], result['destination'], result['body'])
+            except Exception as e:
+                if isinstance(e, PartialDelivery):
+                    result['body'] = e.remainder
+
+                print(f"{result['channel']} delivery to {result['destination']} failed: {e}")
+                result['status'] = 'failed'
+                result['error'] = f"{type(e).__name__}: {e}"
+
+                if attempt < deliveryRetries:
+                    result['retries'] += 1
+                    time.sleep(min(2 ** attempt, run_budget.remaining()))
+                continue
+
+            if remainder:
+                result['status'] = 'deferred'
+                result['body'] = remainder
+            else:
+                result['status'] = 'sent'
+            break
+
+        result['latency'] = time.monotonic() - started
+
+    return result
+
+
+def deliveryJobs(comms, personal=()):
+
+    # anything left over from previous runs goes out first
+    jobs = []
+    for delivery in fetch_dicts(dbconn, "SELECT * FROM pending_deliveries ORDER BY id;"):
+        jobs.append({
+            'channel': delivery['channel'],
+            'destination': delivery['destination'],
+            'body': delivery['body'],
+            'pending_id': delivery['id'],
+            'created': delivery['created'],
+            'attempts': delivery['attempts'],
+        })
+
+    if len(comms) > 0:
+        destinations = []
+
+        if dreamhostAnounces:
+            destinations.append(('dreamhost', listName))
+        if emailAlerts:
+            destinations += [('email', destEmail) for destEmail in destAddr]
+        if slackAlerts:
+            destinations += [('slack', webhook_url) for webhook_url in webhook_urls]
+        if discordAlerts:
+            destinations += [('discord', discord_webhook_url) for discord_webhook_url in discord_webhook_urls]
+
+        for channel, destination in destinations:
+            jobs.append({
+                'channel': channel,
+                'destination': destination,
+                'body': comms,
+                'pending_id': None,
+                'created': unix_timestamp,
+                'attempts': 0,
+            })
+
+    # alerts for individual subscribers, see subscriberAlerts
+    for channel, destination, body in personal:
+        jobs.append({
+            'channel': channel,
+            'destination': destination,
+            'body': body,
+            'pending_id': None,
+            'created': unix_timestamp,
+            'attempts': 0,
+        })
+
+    return jobs
+
+
+def previewAlerts(comms, personal=()):
+
+    # everything deliverAlerts would send this run, without sending any of it
+    jobs = deliveryJobs(comms, personal)
+
+    for job in jobs:
+        kind = "new" if job['pending_id'] is None else f"pending, {job['attempts']} attempts"
+        print(f"Would deliver to {job['channel']} {job['destination']} ({kind}, {len(job['body'])} characters)")
+
+    if len(jobs) == 0:
+        print("Nothing would be delivered")
+
+    if dry_run == "-":
+        print(comms)
+    else:
+        with open(dry_run, "w") as f:
+            f.write(comms)
+        print(f"Digest written to {dry_run}")
+
+
+def deliverAlerts(comms, personal=()):
+
+    # every destination on every channel is delivered to at once, with each
+    # channel limited to deliveryConcurrency connections
+    jobs = deliveryJobs(comms, personal)
+    if len(jobs) < 1:
+        return []
+
+    # a pool per channel, so a backlog on one channel never holds up another
+    with contextlib.ExitStack() as stack:
+        executors = {}
+        for channel in {job['channel'] for job in jobs}:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=deliveryConcurrency[channel])
+            executors[channel] = stack.enter_context(executor)
+
+        futures = [executors[job['channel']].submit(deliveryJob, job) for job in jobs]
+        results = [future.result() for future in futures]
+
+    # the DB is only touched from this thread
+    for result in results:
+        recordDelivery(result)
+
+    return results
+
+
+def recordDelivery(result):
+
+    query = """INSERT INTO delivery_log (run, channel, destination, status, latency, retries, error)
+                VALUES (?,?,?,?,?,?,?) """
+
+    args = (unix_timestamp, result['channel'], result['destination'], result['status'], result['latency'], result['retries'], result['error'])
+    dbconn.execute(query, args)
+
+    print(f"{result['channel']} to {result['destination']}: {result['status']} in {result['latency']:.1f}s with {result['retries']} retries")
+
+    if result['pending_id'] is None:
+
+        # a failed announcement is handled by rolling the DB back, everything
+        # else that didn't make it goes in the queue for the next run
+        if result['status'] == 'deferred' or (result['status'] == 'failed' and result['channel'] != 'dreamhost'):
+            deferDelivery(result['channel'], result['destination'], result['body'], int(result['status'] == 'failed'))
+
+    elif result['status'] == 'sent':
+        dbconn.execute("DELETE FROM pending_deliveries WHERE id = ?;", (result['pending_id'],))
+
+    elif result['status'] == 'failed' and result['attempts'] + 1 >= pendingMaxAttempts:
+        dbconn.execute("DELETE FROM pending_deliveries WHERE id = ?;", (result['pending_id'],))
+        adminAlert(f"{result['channel']} delivery", "GaveUp", f"Giving up on deferred delivery to {result['destination']} first queued at {adminAlert_time(result['created'])}", result['error'] or "")
+
+    else:
+        query = "UPDATE pending_deliveries SET body = ?, attempts = ? WHERE id = ?;"
+        args = (result['body'], result['attempts'] + int(result['status'] == 'failed'), result['pending_id'])
+        dbconn.execute(query, args)
+
+
+def deferDelivery(channel, destination, body, attempts=0):
+
+    # queue it up for the next run
+    query = """INSERT INTO pending_deliveries (created, channel, destination, body, attempts)
+                VALUES (?,?,?,?,?) """
+
+    dbconn.execute(query, (unix_timestamp, channel, destination, body, attempts))
+    print(f"Deferred {channel} delivery to {destination} until the next run")
+
+
+def html_cleanString(s):
+
+    try:
+        s = str(lxml.html.fromstring(s).text_content())
+    except:
+        pass
+
+    s = s.strip().replace('\r','').replace('\n','').rstrip(',')
+
+    return s
+
+
+def fetchPage(source, url):
+
+    with profileStage(f"fetch:{source}"):
+        req = requests.get(url, timeout=run_budget.timeout())
+
+        archivePage(source, req.status_code, req.content)
+
+    if req.status_code != 200:
         print(f"Failed to fetch page: {req.reason}")
         raise Exception("reqest_not_ok")
 
-    doc = lxml.html.fromstring(req.content)
+    return req.content
+
+
+def parsePage(source, content):
+
+    with profileStage(f"parse:{source}"):
+        return exposure_sources[source]['parse'](content)
+
+
+def exposure_contentFields(source):
+
+    # fields that can be edited on a listed exposure without it becoming a
+    # different exposure
+    return [field for field in exposure_sources[source]['fields'] if field not in exposure_sources[source]['key']]
+
+
+def exposure_contentHash(source, exposure):
+
+    content = [exposure[field] for field in exposure_contentFields(source)]
+
+    return hashlib.sha1(json.dumps(content).encode("utf-8")).hexdigest()
+
+
+def filterExposures(source, exposures, seen_at=None):
+
+    # diff the scrape against every row we have for the source in one pass.
+    # Rows are matched on their key fields, a match whose other fields have
+    # changed is an update, a removed row that has come back is treated as new
+    # and no match at all is a new exposure with an id of 'None'
+    if seen_at is None:
+        seen_at = unix_timestamp
+
+    key = exposure_sources[source]['key']
+    content = exposure_contentFields(source)
+
+    with profileStage(f"dedup:{source}"):
+        # removed rows first so a listed row with the same key wins
+        query = f"SELECT * FROM {source}_exposures ORDER BY removed_at IS NULL, id;"
+
+        stored = {}
+        for row in fetch_dicts(dbconn, query):
+            stored[tuple(row[field] for field in key)] = row
+
+        filtered = []
+        scraped = set()
+
+        for exposure in exposures:
+
+            exposure_key = tuple(exposure[field] for field in key)
+            if exposure_key in scraped:
+                continue
+            scraped.add(exposure_key)
+
+            exposure['first_seen'] = seen_at
+            exposure['last_seen'] = seen_at
+            exposure['content_hash'] = exposure_contentHash(source, exposure)
+            exposure['changes'] = []
+
+            row = stored.get(exposure_key)
+            if row is None:
+                exposure['id'] = None
+                exposure['removed_at'] = None
+            else:
+                exposure['id'] = row['id']
+                exposure['removed_at'] = row['removed_at']
+
+                if row['content_hash'] != exposure['content_hash']:
+                    exposure['changes'] = [(field, row[field], exposure[field]) for field in content if row[field] != exposure[field]]
+
+            filtered.append(exposure)
+
+    return filtered
+
+
+def wahealth_GetLocations():
+
+    return filterExposures('wahealth', parsePage('wahealth', fetchPage('wahealth', waGovUrl)))
+
+
+def wahealth_parsePage(content):
+
+    doc = lxml.html.fromstring(content)
+
+    sites_table = doc.xpath('//table[@id="locationTable"]')[0][1]
+    rows = sites_table.xpath(".//tr")
+
+    # check for proper header
+    header = doc.xpath('//table[@id="locationTable"]')[0][0]
+    headerRows = header.xpath(".//th")
+
+    if (headerRows[0].text_content() == 'Exposure date & time' and 
+    headerRows[1].text_content() == 'Suburb' and
+    headerRows[2].text_content() == 'Location' and
+    headerRows[3].text_content() == 'Date updated' and
+    headerRows[4].text_content() == 'Health advice'):
+        pass
+    else:
+        raise Exception("WAHealth Failed - Parsing page failure")
+
+    if len(rows) < 1:
+        print(f"found no data")
+        raise Exception("table_parse_fail")
+
+    outRows = []
+
+    for row in rows:
+        record = {}
+
+        record['datentime'] = wahealth_cleanString(row[1].text_content())
+        record['suburb'] = wahealth_cleanString(row[2].text_content())
+        record['location'] = wahealth_cleanString(row[3].text_content())
+        record['updated'] = wahealth_cleanString(row[4].text_content())
+        record['advice'] = wahealth_cleanString(row[5].text_content())
+
+        outRows.append(record)
+
+    return outRows
+
+
+def wahealth_cleanString(location):
+
+    newLoc = ""
+    location = location.replace("\xa0", "")
+    for line in location.split("\n"):
+        newLoc = newLoc + line.lstrip().rstrip() + ", "
+    return newLoc.rstrip(", ").lstrip(", ").replace(", , ", "; ").replace(" , ", " ").rstrip("\r\n")
+
+
+def wahealth_buildDetails(exposure):
+    exposure_details = f"""Date and Time: {exposure['datentime']}
+Suburb: {exposure['suburb']}
+Location: {exposure['location']}
+Updated: {exposure['updated']}
+Advice: {exposure['advice']}\n\n"""
+    
+    return exposure_details
+
+
+def sheet_GetLocations():
+
+    # Consumer: https://docs.google.com/spreadsheets/d/1-U8Ea9o9bnST5pzckC8lzwNNK_jO6kIVUAi5Uu_-Ltc/edit?fbclid=IwAR3EaVvU0di14R6zqqfFP7sDLCwPOYax_SjMcDlmV2D2leqKGRAROCInpj4#gid=1427159313
+    # Detailed/Admin: https://docs.google.com/spreadsheets/d/12fN17qFR8ruSk2yf29CR1S6xZMs_nve2ww_6FJk7__8/edit#gid=0
+
+    sheet_id = "1-U8Ea9o9bnST5pzckC8lzwNNK_jO6kIVUAi5Uu_-Ltc"
+    sheet_name = "All%20Locations"
+    url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq?tqx=out:csv&sheet={sheet_name}"
+
+    res = requests.get(url, stream=True, timeout=run_budget.timeout())
+
+    if res.status_code != 200:
+        print(f"Failed to fetch page: {res.reason}")
+        raise Exception("reqest_not_ok")
+
+    # decode and parse the sheet a line at a time as it arrives, so only one
+    # batch of rows is ever held in memory
+    decoder = codecs.getincrementaldecoder('UTF-8')()
+    stream = archiveStream('sheet', res.status_code)
+    lines = (decoder.decode(stream.write(line + b"\n")) for line in res.iter_lines(chunk_size=65536))
+
+    sheetExposures = []
+    newKeys = set()
+    batch = []
+    found = 0
+
+    try:
+        for exposure in sheet_parseLines(lines):
+
+            batch.append(exposure)
+            found += 1
+
+            if len(batch) >= sheet_batchSize:
+                with profileStage("dedup:sheet"):
+                    sheetExposures += sheet_filterBatch(batch, newKeys)
+                batch = []
+
+        with profileStage("dedup:sheet"):
+            sheetExposures += sheet_filterBatch(batch, newKeys)
+    except BaseException:
+        stream.abort()
+        raise
+
+    stream.close()
+
+    if(found < 1):
+        raise Exception("Sheets Failed - Zero records retrieved")
+
+    return sheetExposures
+
+
+def sheet_parseLines(lines):
+
+    reader = csv.reader(line.replace('"",','') for line in lines)
+
+    for record in reader:
+
+        if len(record) < 5 or record[4] != "Business":
+            continue
+
+        exposure = {}
+        exposure['datentime'] = html_cleanString(record[2])
+        exposure['suburb'] = html_cleanString(record[1])
+        exposure['location'] = html_cleanString(record[0]) + " " + html_cleanString(record[3])
+
+        yield exposure
+
+
+def sheet_parsePage(content):
+
+    sheetExposures = list(sheet_parseLines(codecs.decode(content, 'UTF-8').splitlines()))
+
+    if(len(sheetExposures) < 1):
+        raise Exception("Sheets Failed - Zero records retrieved")
+
+    return sheetExposures
+
+
+# each row takes 3 query parameters, keep batches under sqlite's default
+# limit of 999
+sheet_batchSize = 300
+
+
+def sheet_filterBatch(batch, newKeys):
+
+    # look the whole batch up in one query, bump last_seen on the rows we
+    # already have and only hand back the new ones
+    if len(batch) < 1:
+        return []
+
+    where = " OR ".join("(datentime = ? AND suburb = ? AND location = ?)" for exposure in batch)
+    query = f"""SELECT id, datentime, suburb, location, removed_at FROM sheet_exposures WHERE {where}
+                ORDER BY removed_at IS NULL, id;"""
+
+    args = []
+    for exposure in batch:
+        args += [exposure['datentime'], exposure['suburb'], exposure['location']]
+
+    existing = {}
+    for row in dbconn.execute(query, args):
+        existing[(row[1], row[2], row[3])] = (row[0], row[4])
+
+    if len(existing) > 0:
+        ids = [id for id, removed_at in existing.values()]
+        query = f"UPDATE sheet_exposures SET last_seen = ? WHERE id IN ({','.join('?' * len(ids))});"
+        dbconn.execute(query, [unix_timestamp] + ids)
+
+    newExposures = []
+    for exposure in batch:
+        key = (exposure['datentime'], exposure['suburb'], exposure['location'])
+
+        exposure['id'], exposure['removed_at'] = existing.get(key, (None, None))
+
+        # rows still listed need nothing more, but one that was removed and
+        # has come back goes through as new
+        if exposure['id'] is not None and exposure['removed_at'] is None:
+            continue
+
+        # the sheet sometimes lists the same site twice, only the rows we
+        # hand back are remembered so the set stays as small as the result
+        if key in newKeys:
+            continue
+        newKeys.add(key)
+
+        exposure['first_seen'] = unix_timestamp
+        exposure['last_seen'] = unix_timestamp
+        exposure['content_hash'] = exposure_contentHash('sheet', exposure)
+        exposure['changes'] = []
+        newExposures.append(exposure)
+
+    return newExposures
+
+
+
+def sheet_buildDetails(exposure):
+    exposure_details = f"""Date and Time: {exposure['datentime']}
+Suburb: {exposure['suburb']}
+Location: {exposure['location']}\n\n"""
+    
+    return exposure_details
+
+
+def ecu_GetLocations():
+    ecu_url = 'https://www.ecu.edu.au/covid-19/advice-for-staff'
+
+    return filterExposures('ecu', parsePage('ecu', fetchPage('ecu', ecu_url)))
+
+
+def ecu_parsePage(content):
+
+    doc = lxml.html.fromstring(content)
+
+    # an empty table is fine, it just means nothing is listed, but no
+    # tables at all means the page has changed
+    containers = doc.xpath('//div[@id="accordion-01e803ff84807e270adaddf7ade2fa91035b560d"]')
+    if len(containers) < 1 or len(containers[0].xpath(".//table")) < 1:
+        raise Exception("ECU Failed - Parsing page failure")
+
+    tables = containers[0].xpath(".//table")
+
+    outRows = []
+
+
+    for table in tables:
+        campus = html_cleanString(table.getparent().getparent().getparent().getparent()[0].text_content().strip())
+        rows = table.xpath('./tr')
+
+        for row in rows:
+            record = {}
+
+            record['campus'] = campus
+            record['date'] = html_cleanString(row[0].text_content().strip())
+            record['time'] = html_cleanString(row[1].text_content().strip())
+            record['building'] = html_cleanString(row[2].text_content().strip())
+            record['room'] = html_cleanString(row[3].text_content().strip())
+
+            outRows.append(record)
+
+    for table in tables:
+        header = table.xpath('.//thead')[0][0]
+
+        if (header[0].text_content().strip() == 'Date' and
+            header[1].text_content().strip() == 'Time' and
+            header[2].text_content().strip() == 'Building' and
+            header[3].text_content().strip() == 'Room'):
+            pass
+        else:
+            raise Exception("ECU Failed - Parsing page failure")
+
+    return outRows
+
+
+def ecu_buildDetails(exposure):
+    exposure_details = f"""Date: {exposure['date']}
+Time: {exposure['time']}
+Campus: {exposure['campus']}
+Building: {exposure['building']}
+Room: {exposure['room']}\n\n"""
+    
+    return exposure_details
+
+
+def uwa_GetLocations():
+    uwa_url = 'https://www.uwa.edu.au/covid-19-faq/Home'
+
+    return filterExposures('uwa', parsePage('uwa', fetchPage('uwa', uwa_url)))
+
+
+def uwa_parsePage(content):
+
+    doc = lxml.html.fromstring(content)
+
+    rows = doc.xpath('//div/table/tbody/tr')
+    if len(rows) < 1:
+        raise Exception("UWA Failed - Parsing page failure")
+
+    header = rows.pop(0)
+
+    outRows = []
+
+    for row in rows:
+        record = {}
+
+        # kludge as there are empty rows with a single cell sometimes :(
+        if(len(row) < 3):
+            continue
+
+        record['date'] = html_cleanString(row[0].text_content().strip())
+        record['location'] = html_cleanString(row[1].text_content().strip())
+        record['time'] = html_cleanString(row[2].text_content().strip())
+
+        outRows.append(record)
+
+
+    if (header[0].text_content().strip() == 'Date' and
+        header[1].text_content().strip() == 'Location' and
+        header[2].text_content().strip() == 'Time'):
+        pass
+    else:
+        raise Exception("UWA Failed - Parsing page failure")
+
+    return outRows
+
+
+def uwa_buildDetails(exposure):
+    exposure_details = f"""Date: {exposure['date']}
+Time: {exposure['time']}
+Location: {exposure['location']}\n\n"""
+    
+    return exposure_details
+
+
+def murdoch_GetLocations():
+    murdoch_url = 'https://www.murdoch.edu.au/notices/covid-19-advice'
+
+    return filterExposures('murdoch', parsePage('murdoch', fetchPage('murdoch', murdoch_url)))
+
+
+def murdoch_parsePage(content):
+
+    doc = lxml.html.fromstring(content)
+
+    rows = doc.xpath('//tr')
+    if len(rows) < 1:
+        raise Exception("Murdoch Failed - Parsing page failure")
+
+    header = rows.pop(0)
+
+    outRows = []
+
+    for row in rows:
+        record = {}
+
+        record['date'] = html_cleanString(row[0].text_content().strip())
+        record['time'] = html_cleanString(row[1].text_content().strip())
+        record['campus'] = html_cleanString(row[2].text_content().strip())
+        record['location'] = html_cleanString(row[3].text_content().strip())
+
+        outRows.append(record)
+
+
+    if (header[0].text_content().strip() == 'Date' and
+        header[1].text_content().strip() == 'Time' and
+        header[2].text_content().strip() == 'Campus' and 
+        header[3].text_content().strip() == 'Location'):
+
+        pass
+    else:
+        raise Exception("Murdoch Failed - Parsing page failure")
+
+    return outRows
+
+
+def murdoch_buildDetails(exposure):
+    exposure_details = f"""Date: {exposure['date']}
+Time: {exposure['time']}
+Campus: {exposure['campus']}
+Location: {exposure['location']}\n\n"""
+    
+    return exposure_details
+
+
+def curtin_GetLocations():
+    curtin_url = 'https://www.curtin.edu.au/novel-coronavirus/recent-exposure-sites-on-campus/'
+
+    return filterExposures('curtin', parsePage('curtin', fetchPage('curtin', curtin_url)))
+
+
+def curtin_parsePage(content):
+
+    doc = lxml.html.fromstring(content)
+
+    tables = doc.xpath('//table[@id="table_1"]')
+    if len(tables) < 1 or len(tables[0].xpath('.//tr')) < 1:
+        raise Exception("Curtin Failed - Parsing page failure")
+
+    rows = tables[0].xpath('.//tr')
+
+    header = rows.pop(0)
+
+    outRows = []
+
+    for row in rows:
+        record = {}
+
+        record['date'] = html_cleanString(row[0].text_content().strip())
+        record['time'] = html_cleanString(row[1].text_content().strip())
+        record['campus'] = html_cleanString(row[2].text_content().strip())
+        record['location'] = html_cleanString(row[3].text_content().strip())
+        record['contact_type'] = html_cleanString(row[4].text_content().strip())
+
+        outRows.append(record)
+
+
+    if (header[0].text_content().strip() == 'Date' and
+        header[1].text_content().strip() == 'Time' and
+        header[2].text_content().strip() == 'Campus' and 
+        header[3].text_content().strip() == 'Location' and 
+        header[4].text_content().strip() == 'Contact type'):
+
+        pass
+    else:
+        raise Exception("Curtin Failed - Parsing page failure")
+
+    return outRows
+
+
+def curtin_buildDetails(exposure):
+    exposure_details = f"""Date: {exposure['date']}
+Time: {exposure['time']}
+Campus: {exposure['campus']}
+Location: {exposure['location']}
+Contact Type: {exposure['contact_type']}\n\n"""
+    
+    return exposure_details
+
+
+# Exposure sources, keyed by the prefix used for their table and functions.
+# Fields are listed in the order they are displayed and 'key' is the fields
+# that identify an exposure, the rest can be edited while it's listed. 'place'
+# is where an exposure is, for looking up in the gazetteer, 'venue' what it
+# is and 'when' its date and time, for matching it with the same site from
+# another source. 'get' fetches the source's exposures ready for ingesting,
+# 'parse' turns a fetched page into exposures and 'details' formats one for
+# comms.
+exposure_sources = {
+    'wahealth': {
+        'title': "WA Health Exposure Sites",
+        'fields': ['datentime', 'suburb', 'location', 'updated', 'advice'],
+        'key': ['datentime', 'suburb', 'location'],
+        'place': "{suburb}",
+        'venue': "{location}",
+        'when': "{datentime}",
+        'get': wahealth_GetLocations,
+        'parse': wahealth_parsePage,
+        'details': wahealth_buildDetails,
+    },
+    'sheet': {
+        'title': "Unofficial Civilian Compiled Exposure Sites",
+        'fields': ['datentime', 'suburb', 'location'],
+        'key': ['datentime', 'suburb', 'location'],
+        'place': "{suburb}",
+        'venue': "{location}",
+        'when': "{datentime}",
+        'get': sheet_GetLocations,
+        'parse': sheet_parsePage,
+        'details': sheet_buildDetails,
+    },
+    'ecu': {
+        'title': "Edith Cowan University Exposure Sites",
+        'fields': ['date', 'time', 'campus', 'building', 'room'],
+        'key': ['date', 'time', 'campus', 'building', 'room'],
+        'place': "ECU {campus}",
+        'venue': "{building} {room}",
+        'when': "{date} {time}",
+        'get': ecu_GetLocations,
+        'parse': ecu_parsePage,
+        'details': ecu_buildDetails,
+    },
+    'uwa': {
+        'title': "University of Western Australia Exposure Sites",
+        'fields': ['date', 'time', 'location'],
+        'key': ['date', 'time', 'location'],
+        'place': "UWA Crawley",
+        'venue': "{location}",
+        'when': "{date} {time}",
+        'get': uwa_GetLocations,
+        'parse': uwa_parsePage,
+        'details': uwa_buildDetails,
+    },
+    'murdoch': {
+        'title': "Murdoch University Exposure Sites",
+        'fields': ['date', 'time', 'campus', 'location'],
+        'key': ['date', 'time', 'campus', 'location'],
+        'place': "Murdoch {campus}",
+        'venue': "{location}",
+        'when': "{date} {time}",
+        'get': murdoch_GetLocations,
+        'parse': murdoch_parsePage,
+        'details': murdoch_buildDetails,
+    },
+    'curtin': {
+        'title': "Curtin University Exposure Sites",
+        'fields': ['date', 'time', 'campus', 'location', 'contact_type'],
+        'key': ['date', 'time', 'campus', 'location', 'contact_type'],
+        'place': "Curtin {campus}",
+        'venue': "{location}",
+        'when': "{date} {time}",
+        'get': curtin_GetLocations,
+        'parse': curtin_parsePage,
+        'details': curtin_buildDetails,
+    },
+}
+
+field_labels = {
+    'datentime': "Date and Time",
+    'date': "Date",
+    'time': "Time",
+    'suburb': "Suburb",
+    'campus': "Campus",
+    'building': "Building",
+    'room': "Room",
+    'location': "Location",
+    'updated': "Updated",
+    'advice': "Advice",
+    'contact_type': "Contact Type",
+}
+
+
+def source_health(conn, source):
+
+    rows = fetch_dicts(conn, "SELECT * FROM source_health WHERE source = ?;", (source,))
+    if rows:
+        return rows[0]
+
+    return {
+        'source': source,
+        'consecutive_failures': 0,
+        'last_success': None,
+        'last_failure': None,
+        'last_error': None,
+        'next_attempt': 0,
+    }
+
+
+def source_shouldAttempt(health):
+
+    # once a source's circuit is open we leave it alone until its backoff
+    # expires, then give it one more go
+    return (health['next_attempt'] or 0) <= unix_timestamp
+
+
+def source_recordSuccess(conn, source):
+
+    conn.execute("INSERT OR IGNORE INTO source_health (source) VALUES (?);", (source,))
+
+    query = """UPDATE source_health SET consecutive_failures = 0, last_success = ?, next_attempt = 0
+                WHERE source = ?;"""
+
+    conn.execute(query, (unix_timestamp, source))
+
+
+def source_recordFailure(conn, source, error):
+
+    failures = source_health(conn, source)['consecutive_failures'] + 1
+
+    next_attempt = 0
+    if failures >= sourceFailureThreshold:
+        backoff = min(sourceBackoff * 2 ** (failures - sourceFailureThreshold), sourceBackoffMax)
+        next_attempt = unix_timestamp + backoff
+
+    conn.execute("INSERT OR IGNORE INTO source_health (source) VALUES (?);", (source,))
+
+    query = """UPDATE source_health SET consecutive_failures = ?, last_failure = ?, last_error = ?, next_attempt = ?
+                WHERE source = ?;"""
+
+    args = (failures, unix_timestamp, f"{type(error).__name__}: {error}", next_attempt, source)
+    conn.execute(query, args)
+
+    return next_attempt
+
+
+def ingestExposures(source, exposures, seen_at=None):
+
+    # add new exposures to the DB, apply edits to listed ones and mark any
+    # listed row missing from the scrape as removed. Returns the new, updated
+    # and removed exposures for comms.
+    if seen_at is None:
+        seen_at = unix_timestamp
+
+    table = f"{source}_exposures"
+    fields = exposure_sources[source]['fields']
+    content = exposure_contentFields(source)
+    columns = fields + ['first_seen', 'last_seen', 'content_hash']
+
+    events = {'new': [], 'updated': [], 'removed': []}
+
+    with profileStage(f"ingest:{source}"):
+        for exposure in exposures:
+
+            if exposure['id'] is None:
+                events['new'].append(exposure)
+
+                query = f"""INSERT INTO {table} ({', '.join(columns)}) 
+                            VALUES ({','.join('?' * len(columns))}) """
+
+                args = tuple(exposure[column] for column in columns)
+                exposure['id'] = dbconn.execute(query, args).lastrowid
+                continue
+
+            if exposure['removed_at'] is not None:
+                events['new'].append(exposure)
+            elif len(exposure['changes']) > 0:
+                events['updated'].append(exposure)
+
+            if exposure['removed_at'] is not None or len(exposure['changes']) > 0:
+                # never let an older snapshot overwrite a newer one
+                assignments = "".join(f"{field} = ?, " for field in content)
+                query = f"""UPDATE {table} SET {assignments}content_hash = ?, updated_at = ?, removed_at = NULL
+                            WHERE id = ? AND last_seen <= ? """
+
+                args = tuple(exposure[field] for field in content) + (exposure['content_hash'], seen_at, exposure['id'], seen_at)
+                dbconn.execute(query, args)
+
+            # min/max so replaying old snapshots never moves these the wrong way
+            query = f"""UPDATE {table} SET first_seen = min(first_seen, ?), last_seen = max(last_seen, ?) 
+                        WHERE id = ? """
+
+            args = (exposure['first_seen'], exposure['last_seen'], exposure['id'])
+            dbconn.execute(query, args)
+
+        # everything listed in this scrape now has a last_seen of seen_at
+        query = f"SELECT * FROM {table} WHERE removed_at IS NULL AND last_seen < ? ORDER BY first_seen, id;"
+        events['removed'] = fetch_dicts(dbconn, query, (seen_at,))
+
+        if len(events['removed']) > 0:
+            query = f"UPDATE {table} SET removed_at = ? WHERE removed_at IS NULL AND last_seen < ?;"
+            dbconn.execute(query, (seen_at, seen_at))
+
+    return events
+
+
+def buildChangeDetails(source, exposure):
+
+    changes = "".join(f"Previous {field_labels[field]}: {old}\n" for field, old, new in exposure['changes'])
+
+    return exposure_sources[source]['details'](exposure).rstrip("\n") + "\n" + changes + "\n"
+
+
+def buildDuplicateDetails(source, exposure):
+
+    # a new exposure along with where else it's listed, with the details of
+    # each other listing so nothing a merged row said is lost
+    also = ""
+    for other_source, other in exposure.get('also_listed', []):
+        other_details = exposure_sources[other_source]['details'](other).rstrip("\n")
+        also += f"Also listed by: {duplicate_link(other_source, other)}\n" + "".join(f"  {line}\n" for line in other_details.split("\n"))
+
+    also += "".join(f"Previously listed by: {duplicate_link(*listing)}\n" for listing in exposure.get('previously_listed', []))
+
+    details = exposure_sources[source]['details'](exposure)
+    if len(also) < 1:
+        return details
+
+    return details.rstrip("\n") + "\n" + also + "\n"
+
+
+def buildReport(source, events):
+
+    # a section per kind of change, new exposures first under the plain title.
+    # New exposures merged into another source's are left out.
+    title = exposure_sources[source]['title']
+    buildDetails = exposure_sources[source]['details']
+
+    sections = {
+        'new': (title, lambda exposure: buildDuplicateDetails(source, exposure)),
+        'updated': (f"{title} - Updated", lambda exposure: buildChangeDetails(source, exposure)),
+        'removed': (f"{title} - No Longer Listed", buildDetails),
+    }
+
+    report = ""
+
+    for event in reportEvents:
+        heading, details = sections[event]
+
+        exposures = [exposure for exposure in events[event] if exposure.get('duplicate_of') is None]
+
+        if len(exposures) > 0:
+            report = report + f"*{heading}*\n\n" + "".join(details(exposure) for exposure in exposures) + "\n\n"
+
+    return report
+
+
+duplicate_months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+# words too common to say two sites are the same place
+duplicate_stopwords = {
+    'and', 'the', 'for', 'from', 'near', 'level', 'floor', 'room', 'building',
+    'campus', 'shop', 'store', 'unit', 'centre', 'center', 'shopping', 'street',
+    'road', 'avenue', 'highway', 'drive', 'north', 'south', 'east', 'west',
+}
+
+
+def duplicate_date(when):
+
+    # sources write dates as 21/01/2022, 21/1 or Friday 21 January, so
+    # compare them as month-day
+    match = re.search(r"\b(\d{1,2})/(\d{1,2})(?:/\d{2,4})?\b", when)
+    if match:
+        day, month = int(match.group(1)), int(match.group(2))
+    else:
+        match = re.search(r"\b(\d{1,2})(?:st|nd|rd|th)?\s+(" + "|".join(duplicate_months) + r")", when.lower())
+        if match is None:
+            return None
+        day, month = int(match.group(1)), duplicate_months.index(match.group(2)) + 1
+
+    if not (1 <= day <= 31 and 1 <= month <= 12):
+        return None
+
+    return f"{month:02d}-{day:02d}"
+
+
+def duplicate_time(when):
+
+    # the start time in minutes past midnight, from 10am, 10:30 am or 14:30
+    match = re.search(r"\b(\d{1,2})(?:[:.](\d{2}))?\s*(am|pm)\b|\b(\d{1,2}):(\d{2})\b", when.lower())
+    if match is None:
+        return None
+
+    if match.group(3) is not None:
+        hour, minute = int(match.group(1)) % 12, int(match.group(2) or 0)
+        if match.group(3) == "pm":
+            hour += 12
+    else:
+        hour, minute = int(match.group(4)), int(match.group(5))
+
+    if hour > 23 or minute > 59:
+        return None
+
+    return hour * 60 + minute
+
+
+# street addresses, like the sheet adds to its locations: "1 Rokeby Rd"
+duplicate_address = re.compile(
+    r"\b\d+[a-z]?(?:\s*[-/]\s*\d+[a-z]?)?\s+(?:[a-z']+\s+){1,3}"
+    r"(?:rd|road|st|street|ave|avenue|hwy|highway|dr|drive|pde|parade|tce|terrace|way|pl|place|"
+    r"cres|crescent|ct|court|blvd|boulevard|lane|ln|cl|close|cct|circuit)\b\.?",
+    re.IGNORECASE)
+
+
+def duplicate_canonical(source, exposure):
+
+    # the words of a site's place and venue without any street address,
+    # sorted so word order doesn't matter, along with the numbers in them, the
+    # start time and the blocks it's filed under: its date with each
+    # distinctive word. Only sites sharing a block are ever compared.
+    when = exposure_sources[source]['when'].format(**exposure)
+    day = duplicate_date(when)
+    words = set()
+
+    for template in [exposure_sources[source]['place'], exposure_sources[source]['venue']]:
+        text = duplicate_address.sub(" ", template.format(**exposure))
+        words.update(word for word in geo_normalize(text).split() if word not in duplicate_stopwords)
+
+    canonical = {
+        'words': " ".join(sorted(words)),
+        'numbers': " ".join(sorted(word for word in words if word.isdigit())),
+        'time': duplicate_time(when),
+    }
+
+    if day is None:
+        return canonical, []
+
+    return canonical, [f"{day} {word}" for word in sorted(words) if len(word) >= 4 and not word.isdigit()]
+
+
+def duplicate_score(a, b):
+
+    # numbers like building and room numbers have to agree, as does the start
+    # time where both have one, otherwise it's how alike the words are
+    a_numbers, b_numbers = set(a['numbers'].split()), set(b['numbers'].split())
+    if not (a_numbers <= b_numbers or b_numbers <= a_numbers):
+        return 0.0
+
+    if a['time'] is not None and b['time'] is not None and a['time'] != b['time']:
+        return 0.0
+
+    return difflib.SequenceMatcher(None, a['words'], b['words']).ratio()
+
+
+def duplicate_link(source, exposure):
+
+    # point to the row on the static site if there is one
+    if publishSite:
+        return f"{exposure_sources[source]['title']} {publish_itemUrl(dict(exposure, source=source))}"
+
+    return exposure_sources[source]['title']
+
+
+def findDuplicates(conn, source_events):
+
+    # compare each new exposure with the exposures from other sources in its
+    # blocks, going through the sources in order so the first source to list
+    # a site is the one it's shown under
+    duplicates = {}
+
+    with profileStage("duplicates"):
+        for source in exposure_sources:
+            if source not in source_events:
+                continue
+
+            for exposure in source_events[source]['new']:
+                canonical, blocks = duplicate_canonical(source, exposure)
+                if len(blocks) < 1:
+                    continue
+
+                query = f"""SELECT DISTINCT source, exposure_id, canonical, numbers, time FROM exposure_blocks WHERE
+                            source != ?
+                            AND block IN ({','.join('?' * len(blocks))});"""
+
+                matches = []
+                for other_source, other_id, words, numbers, start_time in conn.execute(query, [source] + blocks):
+                    score = duplicate_score(canonical, {'words': words, 'numbers': numbers, 'time': start_time})
+                    if score >= duplicateThreshold:
+                        matches.append((score, other_source, other_id))
+
+                for block in blocks:
+                    query = """INSERT OR IGNORE INTO exposure_blocks (block, source, exposure_id, canonical, numbers, time)
+                                VALUES (?,?,?,?,?,?) """
+                    conn.execute(query, (block, source, exposure['id'], canonical['words'], canonical['numbers'], canonical['time']))
+
+                for score, other_source, other_id in matches:
+                    query = """INSERT OR IGNORE INTO exposure_duplicates (source, exposure_id, duplicate_source, duplicate_id, score)
+                                VALUES (?,?,?,?,?) """
+                    conn.execute(query, (source, exposure['id'], other_source, other_id, score))
+
+                if len(matches) > 0:
+                    duplicates[(source, exposure['id'])] = sorted(matches, reverse=True)
+
+    return duplicates
+
+
+def mergeDuplicates(conn, source_events, duplicates):
+
+    # a new exposure that duplicates one shown earlier in this report is
+    # folded into it, one that duplicates an exposure from an earlier run is
+    # shown with a link to it. Exposures are only ever folded into one from a
+    # source earlier in the list, so two can never be folded into each other.
+    order = {source: number for number, source in enumerate(exposure_sources)}
+
+    new = {}
+    for source, events in source_events.items():
+        for exposure in events['new']:
+            exposure['duplicate_of'] = None
+            exposure['also_listed'] = []
+            exposure['previously_listed'] = []
+            new[(source, exposure['id'])] = exposure
+
+    for source in exposure_sources:
+        if source not in source_events:
+            continue
+
+        for exposure in source_events[source]['new']:
+            matches = duplicates.get((source, exposure['id']), [])
+
+            for score, other_source, other_id in matches:
+                other = new.get((other_source, other_id))
+
+                if other is None:
+                    query = f"SELECT id, first_seen FROM {other_source}_exposures WHERE id = ?;"
+                    exposure['previously_listed'] += [(other_source, row) for row in fetch_dicts(conn, query, (other_id,))]
+                elif order[other_source] < order[source] and exposure['duplicate_of'] is None:
+                    exposure['duplicate_of'] = (other_source, other) if other['duplicate_of'] is None else other['duplicate_of']
+                    exposure['duplicate_of'][1]['also_listed'].append((source, exposure))
+
+            # a relisted exposure still has its blocks from an earlier run, so
+            # it can be matched before its own source comes up. Fold it in
+            # here, once this exposure's own primary is known.
+            primary = exposure['duplicate_of'] or (source, exposure)
+
+            for score, other_source, other_id in matches:
+                other = new.get((other_source, other_id))
+
+                if other is not None and order[other_source] > order[source] and other['duplicate_of'] is None:
+                    other['duplicate_of'] = primary
+                    primary[1]['also_listed'].append((other_source, other))
+
+    merged = len([exposure for exposure in new.values() if exposure['duplicate_of'] is not None])
+    if merged > 0:
+        print(f"Merged {merged} exposures listed by more than one source")
+
+
+# the gazetteer is only ever read, so lookups are memoized for the life of
+# the process
+@functools.lru_cache(maxsize=4096)
+def geo_normalize(name):
+
+    name = name.lower().replace("&", " and ")
+    name = re.sub(r"\bmt\b", "mount", name)
+    name = re.sub(r"\b(wa|western australia|6\d{3})\b", " ", name)
+    name = re.sub(r"[^a-z0-9]+", " ", name)
+
+    return " ".join(name.split())
+
+
+@functools.lru_cache(maxsize=None)
+def geo_gazetteer():
+
+    places = {}
+    with open(gazetteerFile, newline="") as f:
+        for row in csv.DictReader(f):
+            places[geo_normalize(row['name'])] = (float(row['latitude']), float(row['longitude']))
+
+    return places
+
+
+@functools.lru_cache(maxsize=4096)
+def geo_resolve(place):
+
+    # places are free text, so try the whole thing and then each part of
+    # lists like "Perth / Northbridge" or "Subiaco (Rokeby Rd)"
+    gazetteer = geo_gazetteer()
+
+    for candidate in [place] + re.split(r"[/,;&()]| and ", place):
+        coords = gazetteer.get(geo_normalize(candidate))
+        if coords is not None:
+            return coords
+
+    return None
+
+
+def geo_parsePlace(place):
+
+    # a place name, or coordinates as "lat,lon"
+    match = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*", place)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+
+    return geo_resolve(place)
+
+
+def geo_distance(a, b):
+
+    # haversine, in km
+    lat1, lon1, lat2, lon2 = map(math.radians, a + b)
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+
+    return 6371.0 * 2 * math.asin(math.sqrt(h))
+
+
+def geo_bounds(coords, radius):
+
+    # a box around a circle of radius km, as (min_lat, max_lat, min_lon, max_lon)
+    lat, lon = coords
+    dlat = radius / 111.32
+    dlon = radius / (111.32 * max(math.cos(math.radians(lat)), 0.01))
+
+    return (lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+
+
+def geo_placeExposures(conn, source, exposures):
+
+    # look up and index where each exposure is, returning those we could place
+    placed = []
+    unplaced = set()
+
+    for exposure in exposures:
+        place = exposure_sources[source]['place'].format(**exposure)
+        coords = geo_resolve(place)
+
+        if coords is None:
+            unplaced.add(place)
+            continue
+
+        placed.append((exposure, coords))
+
+        # a relisted exposure has been placed already
+        query = "SELECT count(id) FROM exposure_places WHERE source = ? AND exposure_id = ?;"
+        if conn.execute(query, (source, exposure['id'])).fetchone()[0] > 0:
+            continue
+
+        query = """INSERT INTO exposure_places (source, exposure_id, place, latitude, longitude)
+                    VALUES (?,?,?,?,?) """
+        id = conn.execute(query, (source, exposure['id'], place) + coords).lastrowid
+
+        conn.execute("INSERT INTO exposure_geo VALUES (?,?,?,?,?);", (id,) + geo_bounds(coords, 0))
+
+    if len(unplaced) > 0:
+        print(f"Unable to place {source} exposures at: {'; '.join(sorted(unplaced))}")
+
+    return placed
+
+
+def geo_placeListed(conn):
+
+    # exposures are only placed as they come in while radiusAlerts is on, so
+    # catch up on any listed before then
+    for source in exposure_sources:
+        query = f"""SELECT * FROM {source}_exposures WHERE
+                    removed_at IS NULL
+                    AND id NOT IN (SELECT exposure_id FROM exposure_places WHERE source = ?);"""
+
+        geo_placeExposures(conn, source, fetch_dicts(conn, query, (source,)))
+
+
+def subscriber_add(conn, email, place, coords, radius):
+
+    # subscribing again replaces the old subscription
+    subscriber_remove(conn, email)
+
+    query = """INSERT INTO subscribers (email, place, latitude, longitude, radius, created)
+                VALUES (?,?,?,?,?,?) """
+    id = conn.execute(query, (email, place) + coords + (radius, unix_timestamp)).lastrowid
+
+    conn.execute("INSERT INTO subscriber_geo VALUES (?,?,?,?,?);", (id,) + geo_bounds(coords, radius))
+
+
+def subscriber_remove(conn, email):
+
+    ids = [row[0] for row in conn.execute("SELECT id FROM subscribers WHERE email = ?;", (email,))]
+
+    for id in ids:
+        conn.execute("DELETE FROM subscriber_geo WHERE id = ?;", (id,))
+        conn.execute("DELETE FROM subscribers WHERE id = ?;", (id,))
+
+    return len(ids)
+
+
+def subscriber_match(conn, coords):
+
+    # the R*Tree narrows it down to subscribers whose box covers the point,
+    # then the actual distance decides
+    query = """SELECT subscribers.* FROM subscriber_geo JOIN subscribers ON subscribers.id = subscriber_geo.id WHERE
+                min_lat <= ?
+                AND max_lat >= ?
+                AND min_lon <= ?
+                AND max_lon >= ?;"""
+
+    lat, lon = coords
+    matches = []
+
+    for subscriber in fetch_dicts(conn, query, (lat, lat, lon, lon)):
+        distance = geo_distance((subscriber['latitude'], subscriber['longitude']), coords)
+        if distance <= subscriber['radius']:
+            matches.append((subscriber, distance))
+
+    return matches
+
+
+def subscriber_nearby(conn, coords, radius):
+
+    # exposures still listed within radius km, nearest first. The R*Tree
+    # narrows it down to exposures inside the box around the circle
+    query = """SELECT exposure_places.* FROM exposure_geo JOIN exposure_places ON exposure_places.id = exposure_geo.id WHERE
+                min_lat >= ?
+                AND max_lat <= ?
+                AND min_lon >= ?
+                AND max_lon <= ?;"""
+
+    found = {}
+
+    for place in fetch_dicts(conn, query, geo_bounds(coords, radius)):
+        distance = geo_distance(coords, (place['latitude'], place['longitude']))
+        if distance > radius:
+            continue
+
+        query = f"SELECT * FROM {place['source']}_exposures WHERE id = ? AND removed_at IS NULL;"
+        for exposure in fetch_dicts(conn, query, (place['exposure_id'],)):
+            found[(place['source'], exposure['id'])] = (distance, place['source'], exposure)
+
+    # a site listed by more than one source is only shown under the first
+    listed = set(found)
+    for source, id in listed:
+        query = "SELECT duplicate_source, duplicate_id FROM exposure_duplicates WHERE source = ? AND exposure_id = ?;"
+        if any(tuple(row) in listed for row in conn.execute(query, (source, id))):
+            del found[(source, id)]
+
+    return sorted(found.values(), key=lambda found: found[0])
+
+
+def subscriberAlerts(conn, source_events):
+
+    # an email for each subscriber with any new exposures in their radius
+    found = {}
+
+    with profileStage("subscribers"):
+        for source, events in source_events.items():
+            for exposure, coords in geo_placeExposures(conn, source, events['new']):
+                if exposure.get('duplicate_of') is not None:
+                    continue
+
+                for subscriber, distance in subscriber_match(conn, coords):
+                    found.setdefault(subscriber['id'], (subscriber, []))[1].append((distance, source, exposure))
+
+    personal = []
+
+    for subscriber, exposures in found.values():
+        body = f"New exposure sites within {subscriber['radius']:g} km of {subscriber['place']}\n\n"
+
+        for distance, source, exposure in sorted(exposures, key=lambda found: found[0]):
+            body = body + f"*{exposure_sources[source]['title']}* ({distance:.1f} km away)\n\n" + buildDuplicateDetails(source, exposure)
+
+        personal.append(('email', subscriber['email'], body))
+
+    if len(found) > 0:
+        print(f"Alerting {len(found)} subscribers to exposures near them")
+
+    return personal
+
+
+def subscribe(email, near, radius):
+
+    coords = geo_parsePlace(near)
+    if coords is None:
+        raise Exception(f"Unable to find {near} in {gazetteerFile}")
+
+    global dbconn, run_lock
+
+    # a run rolls the DB back if its announcement fails, which would take a
+    # subscription made part way through it along with it
+    run_lock = acquireRunLock(f"{db_file}.lock")
+    if run_lock is None:
+        print("A run is in progress, try again once it's finished")
+        exit(1)
+
+    dbconn = create_connection(db_file)
+    subscriber_add(dbconn, email, near, coords, radius)
+
+    print(f"Subscribed {email} to exposures within {radius:g} km of {near} ({coords[0]}, {coords[1]})")
+
+    # let them know what is already listed near them, this goes out with the
+    # next run's deliveries
+    geo_placeListed(dbconn)
+    nearby = subscriber_nearby(dbconn, coords, radius)
+
+    if len(nearby) > 0:
+        body = f"Exposure sites currently listed within {radius:g} km of {near}\n\n"
+
+        for distance, source, exposure in nearby:
+            body = body + f"*{exposure_sources[source]['title']}* ({distance:.1f} km away)\n\n" + exposure_sources[source]['details'](exposure)
+
+        deferDelivery('email', email, body)
+
+    dbconn.close()
+
+
+def unsubscribe(email):
+    global run_lock
+
+    run_lock = acquireRunLock(f"{db_file}.lock")
+    if run_lock is None:
+        print("A run is in progress, try again once it's finished")
+        exit(1)
+
+    conn = create_connection(db_file)
+    removed = subscriber_remove(conn, email)
+    conn.close()
+
+    print(f"Removed {removed} subscriptions for {email}")
+
+
+def archive_blobPath(directory, digest, suffix):
+    return os.path.join(directory, digest[:2], digest + suffix)
+
+
+def archive_findBlob(directory, digest):
+
+    for suffix in [".zst", ".gz"]:
+        path = archive_blobPath(directory, digest, suffix)
+        if os.path.exists(path):
+            return path
+
+    return None
+
+
+def archive_isTemp(entry):
+    return entry.is_file() and entry.name.startswith((".archive-", ".publish-"))
+
+
+def archive_compressor(f):
+
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).stream_writer(f, closefd=False)
+
+    return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6)
+
+
+class PageArchiver:
+
+    # pages are stored under the hash of their content, so the same page
+    # fetched run after run is only kept once. Compressing and writing them
+    # happens on a background thread, the index is written from the main
+    # thread as that's the one that owns the DB connection.
 
-    rows = doc.xpath('//tr')
+    def __init__(self, conn, directory):
+        self.conn = conn
+        self.directory = directory
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.suffix = ".zst" if zstandard is not None else ".gz"
 
-    header = rows.pop(0)
+    def index(self, source, status, digest, size):
+        query = """INSERT INTO page_archive (source, fetched_at, status, hash, size)
+                    VALUES (?,?,?,?,?) """
 
-    outRows = []
+        self.conn.execute(query, (source, unix_timestamp, status, digest, size))
 
-    for row in rows:
-        record = {}
+    def store(self, source, status, content):
+        digest = hashlib.sha256(content).hexdigest()
+        self.index(source, status, digest, len(content))
+        self.writer.submit(self.writeBlob, digest, content)
 
-        record['date'] = html_cleanString(row[0].text_content().strip())
-        record['time'] = html_cleanString(row[1].text_content().strip())
-        record['campus'] = html_cleanString(row[2].text_content().strip())
-        record['location'] = html_cleanString(row[3].text_content().strip())
-        record['last_seen'] = unix_timestamp
+    def writeBlob(self, digest, content):
+        if archive_findBlob(self.directory, digest) is not None:
+            return
+
+        if zstandard is not None:
+            data = zstandard.ZstdCompressor(level=10).compress(content)
+        else:
+            data = gzip.compress(content, compresslevel=6)
+
+        atomicWrite(archive_blobPath(self.directory, digest, self.suffix), data)
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+
+
+class ArchiveStream:
+
+    # for responses we read a bit at a time, so they're hashed here as they go
+    # past and compressed into a temp file on the writer thread, which is then
+    # renamed to its hash (or dropped if we already have it) once complete
+    def __init__(self, archiver, source, status):
+        self.archiver = archiver
+        self.source = source
+        self.status = status
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+        if self.archiver is not None:
+            self.archiver.writer.submit(self.open)
+
+    def open(self):
+        os.makedirs(self.archiver.directory, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=self.archiver.directory, prefix=".archive-")
+        self.file = os.fdopen(fd, "wb")
+        self.compressor = archive_compressor(self.file)
+
+    def write(self, chunk):
+        if self.archiver is not None:
+            self.hash.update(chunk)
+            self.size += len(chunk)
+            self.archiver.writer.submit(self.append, chunk)
+
+        return chunk
+
+    def append(self, chunk):
+        self.compressor.write(chunk)
+
+    def finish(self, digest):
+        self.compressor.close()
+        self.file.close()
+
+        if archive_findBlob(self.archiver.directory, digest) is not None:
+            os.remove(self.tmp_path)
+            return
+
+        path = archive_blobPath(self.archiver.directory, digest, self.archiver.suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(self.tmp_path, 0o644)
+        os.replace(self.tmp_path, path)
+
+    def close(self):
+        if self.archiver is None:
+            return
+
+        digest = self.hash.hexdigest()
+        self.archiver.index(self.source, self.status, digest, self.size)
+        self.archiver.writer.submit(self.finish, digest)
+
+    def discard(self):
+        self.compressor.close()
+        self.file.close()
+        os.remove(self.tmp_path)
+
+    def abort(self):
+        # the response didn't come through in full, so don't keep any of it
+        if self.archiver is None:
+            return
+
+        self.archiver.writer.submit(self.discard)
+
+
+page_archiver = None
+
+
+def archivePage(source, status, content):
+
+    if page_archiver is not None:
+        page_archiver.store(source, status, content)
+
+
+def archiveStream(source, status):
+    return ArchiveStream(page_archiver, source, status)
+
+
+def readArchivedPage(path):
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise Exception(f"{path} is zstd compressed and zstandard isn't installed")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=512 * 1024 * 1024)
+
+    return gzip.decompress(data)
+
+
+def pruneArchive(conn, directory):
+
+    # drop index entries past their retention, then any pages nothing refers to
+    cutoff = unix_timestamp - archiveRetentionDays * 86400
+    conn.execute("DELETE FROM page_archive WHERE fetched_at < ?;", (cutoff,))
+
+    # the writer has finished by now and the run lock keeps any other run
+    # out, so temp files are left over from a run that was killed part way
+    # through a write
+    blobs = {}
+    stale = 0
+    if os.path.isdir(directory):
+        for subdir in os.scandir(directory):
+            if archive_isTemp(subdir):
+                os.remove(subdir.path)
+                stale += 1
+            if not subdir.is_dir():
+                continue
+            for blob in os.scandir(subdir.path):
+                if archive_isTemp(blob):
+                    os.remove(blob.path)
+                    stale += 1
+                if blob.name.startswith("."):
+                    continue
+                blobs[blob.name.split(".")[0]] = (blob.path, blob.stat().st_size)
+
+    if stale > 0:
+        print(f"Removed {stale} unfinished writes from the archive")
+
+    query = "SELECT hash, max(fetched_at) FROM page_archive GROUP BY hash ORDER BY max(fetched_at);"
+    last_fetched = conn.execute(query).fetchall()
+    referenced = {row[0] for row in last_fetched}
+
+    removed = 0
+    for digest, (path, size) in list(blobs.items()):
+        if digest not in referenced:
+            os.remove(path)
+            del blobs[digest]
+            removed += 1
+
+    # still over the cap, so let go of the pages we last saw longest ago
+    total = sum(size for path, size in blobs.values())
+    for digest, fetched_at in last_fetched:
+        if total <= archiveMaxBytes:
+            break
+        if digest not in blobs:
+            continue
+
+        path, size = blobs.pop(digest)
+        os.remove(path)
+        conn.execute("DELETE FROM page_archive WHERE hash = ?;", (digest,))
+        total -= size
+        removed += 1
+
+    if removed > 0:
+        print(f"Pruned {removed} pages from the archive, {total} bytes in use")
+
+
+def publish_dayOf(timestamp):
+    return datetime.fromtimestamp(timestamp, pytz.timezone("Australia/Perth")).strftime("%Y-%m-%d")
+
+
+def publish_dayBounds(day):
+    tz = pytz.timezone("Australia/Perth")
+    start = datetime.strptime(day, "%Y-%m-%d")
+
+    return int(tz.localize(start).timestamp()), int(tz.localize(start + timedelta(days=1)).timestamp())
+
+
+def publish_isoTime(timestamp):
+    return datetime.fromtimestamp(timestamp, pytz.timezone("Australia/Perth")).isoformat()
+
+
+def atomicWrite(path, data):
+
+    # write to a temp file in the same directory and rename it over the top,
+    # so the web server never sees a half written file
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".publish-")
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def publish_writeFile(manifest, relpath, content):
+
+    # the ETag is derived from the content only, so unchanged pages keep their
+    # ETag (and their mtime, as they're not rewritten) between runs
+    data = content.encode("utf-8")
+    etag = '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+    path = os.path.join(publishDir, relpath)
+
+    if manifest.get(relpath) == etag and os.path.exists(path):
+        return False
+
+    atomicWrite(path, data)
+    manifest[relpath] = etag
+
+    return True
+
+
+def publish_page(title, body):
+    return f"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<link rel="alternate" type="application/atom+xml" href="/atom.xml">
+<link rel="alternate" type="application/feed+json" href="/feed.json">
+</head>
+<body>
+<h1>{html.escape(title)}</h1>
+{body}
+</body>
+</html>
+"""
+
+
+def publish_changedPages(conn, processed_sources):
+
+    # a (source, day) page needs regenerating if it has rows that were first
+    # seen, updated or removed in this run
+    changed = set()
+
+    for source in processed_sources:
+        query = f"""SELECT DISTINCT first_seen FROM {source}_exposures WHERE
+                    first_seen = ?
+                    OR updated_at = ?
+                    OR removed_at = ?;"""
+
+        for row in conn.execute(query, (unix_timestamp, unix_timestamp, unix_timestamp)):
+            changed.add((source, publish_dayOf(row[0])))
+
+    return changed
 
-        query = """SELECT count(id), coalesce(id, 0) FROM murdoch_exposures WHERE
-                    date = ?
-                    AND time = ?
-                    AND campus = ?
-                    AND location = ?;"""
-        
-        args = (record['date'], record['time'], record['campus'], record['location'])
-        result = dbconn.execute(query, args)
 
-        id = result.fetchone()
-        if id[0] > 0:
-            record['id'] = id[1]
+def publish_allPages(conn):
+
+    pages = set()
+
+    for source in exposure_sources:
+        for row in conn.execute(f"SELECT DISTINCT first_seen FROM {source}_exposures;"):
+            pages.add((source, publish_dayOf(row[0])))
+
+    return pages
+
+
+def publish_buildDayPage(conn, source, day):
+    fields = exposure_sources[source]['fields']
+    start, end = publish_dayBounds(day)
+
+    query = f"""SELECT * FROM {source}_exposures WHERE
+                first_seen >= ?
+                AND first_seen < ?
+                ORDER BY first_seen DESC, id DESC;"""
+
+    rows = fetch_dicts(conn, query, (start, end))
+
+    header = "".join(f"<th>{html.escape(field_labels[field])}</th>" for field in fields)
+    body = f'<p><a href="index.html">All {html.escape(exposure_sources[source]["title"])}</a></p>\n'
+    body += f"<table>\n<tr>{header}<th>First seen</th><th>Status</th></tr>\n"
+
+    for row in rows:
+        cells = "".join(f"<td>{html.escape(str(row[field]))}</td>" for field in fields)
+
+        if row['removed_at'] is None:
+            status = "Listed"
         else:
-            record['id'] = None
-            record['first_seen'] = unix_timestamp
+            status = f"No longer listed (removed {publish_isoTime(row['removed_at'])})"
 
-        outRows.append(record)
+        if row['updated_at'] is not None:
+            status += f", updated {publish_isoTime(row['updated_at'])}"
 
+        body += f'<tr id="row-{row["id"]}">{cells}<td>{publish_isoTime(row["first_seen"])}</td><td>{html.escape(status)}</td></tr>\n'
 
-    if (header[0].text_content().strip() == 'Date' and
-        header[1].text_content().strip() == 'Time' and
-        header[2].text_content().strip() == 'Campus' and 
-        header[3].text_content().strip() == 'Location'):
+    body += "</table>"
 
-        pass
+    return publish_page(f"{exposure_sources[source]['title']} first seen {day}", body)
+
+
+def publish_buildSourcePage(conn, source):
+    days = {}
+
+    for row in conn.execute(f"SELECT first_seen FROM {source}_exposures;"):
+        day = publish_dayOf(row[0])
+        days[day] = days.get(day, 0) + 1
+
+    body = '<p><a href="../index.html">All sources</a></p>\n<ul>\n'
+    for day in sorted(days, reverse=True):
+        body += f'<li><a href="{day}.html">{day}</a> ({days[day]})</li>\n'
+    body += "</ul>"
+
+    return publish_page(exposure_sources[source]['title'], body)
+
+
+def publish_buildIndexPage(conn):
+    body = "<ul>\n"
+
+    for source in exposure_sources:
+        query = f"SELECT count(id), coalesce(sum(removed_at IS NULL), 0) FROM {source}_exposures;"
+        total, listed = conn.execute(query).fetchone()
+
+        body += f'<li><a href="{source}/index.html">{html.escape(exposure_sources[source]["title"])}</a> ({listed} listed, {total} total)</li>\n'
+
+    body += "</ul>"
+
+    return publish_page("WA Covid-19 Exposure Sites", body)
+
+
+def publish_latestExposures(conn):
+    exposures = []
+
+    for source in exposure_sources:
+        query = f"SELECT * FROM {source}_exposures ORDER BY first_seen DESC, id DESC LIMIT ?;"
+        for row in fetch_dicts(conn, query, (publishFeedLength,)):
+            row['source'] = source
+            exposures.append(row)
+
+    exposures.sort(key=lambda row: (row['first_seen'], row['source'], row['id']), reverse=True)
+
+    return exposures[:publishFeedLength]
+
+
+def publish_itemDetails(exposure):
+    fields = exposure_sources[exposure['source']]['fields']
+
+    return "\n".join(f"{field_labels[field]}: {exposure[field]}" for field in fields)
+
+
+def publish_itemTitle(exposure):
+    place = exposure.get('location') or exposure.get('building') or ""
+
+    return f"{exposure_sources[exposure['source']]['title']}: {place}"
+
+
+def publish_itemUrl(exposure):
+    return f"{publishBaseUrl}/{exposure['source']}/{publish_dayOf(exposure['first_seen'])}.html#row-{exposure['id']}"
+
+
+def publish_buildJsonFeed(exposures):
+    feed = {
+        "version": "https://jsonfeed.org/version/1.1",
+        "title": "WA Covid-19 Exposure Sites",
+        "home_page_url": f"{publishBaseUrl}/",
+        "feed_url": f"{publishBaseUrl}/feed.json",
+        "items": [],
+    }
+
+    for exposure in exposures:
+        feed['items'].append({
+            "id": publish_itemUrl(exposure),
+            "url": publish_itemUrl(exposure),
+            "title": publish_itemTitle(exposure),
+            "content_text": publish_itemDetails(exposure),
+            "date_published": publish_isoTime(exposure['first_seen']),
+            "tags": [exposure['source']],
+        })
+
+    return json.dumps(feed, indent=2, sort_keys=True) + "\n"
+
+
+def publish_buildAtomFeed(exposures):
+    # the feed's updated time comes from the data rather than the clock so an
+    # unchanged feed renders byte for byte the same
+    updated = publish_isoTime(exposures[0]['first_seen'] if exposures else 0)
+
+    feed = f"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<title>WA Covid-19 Exposure Sites</title>
+<id>{html.escape(publishBaseUrl)}/</id>
+<link href="{html.escape(publishBaseUrl)}/"/>
+<link rel="self" href="{html.escape(publishBaseUrl)}/atom.xml"/>
+<updated>{updated}</updated>
+"""
+
+    for exposure in exposures:
+        url = html.escape(publish_itemUrl(exposure))
+        published = publish_isoTime(exposure['first_seen'])
+
+        feed += f"""<entry>
+<id>{url}</id>
+<title>{html.escape(publish_itemTitle(exposure))}</title>
+<link href="{url}"/>
+<published>{published}</published>
+<updated>{published}</updated>
+<category term="{exposure['source']}"/>
+<content type="text">{html.escape(publish_itemDetails(exposure))}</content>
+</entry>
+"""
+
+    feed += "</feed>\n"
+
+    return feed
+
+
+def publishStaticSite(conn, processed_sources):
+
+    manifest_path = os.path.join(publishDir, "etags.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    # no manifest means nothing has been published yet (or a rebuild was
+    # forced by deleting it), so generate every page
+    if manifest:
+        pages = publish_changedPages(conn, processed_sources)
     else:
-        raise Exception("Murdoch Failed - Parsing page failure")
+        pages = publish_allPages(conn)
 
-    return outRows
+    if manifest and not pages:
+        print("Publish: no changes")
+        return
 
+    written = 0
+    considered = 0
 
-def murdoch_buildDetails(exposure):
-    exposure_details = f"""Date: {exposure['date']}
-Time: {exposure['time']}
-Campus: {exposure['campus']}
-Location: {exposure['location']}\n\n"""
-    
-    return exposure_details
+    for source, day in sorted(pages):
+        considered += 1
+        written += publish_writeFile(manifest, f"{source}/{day}.html", publish_buildDayPage(conn, source, day))
 
+    for source in sorted({source for source, day in pages}):
+        considered += 1
+        written += publish_writeFile(manifest, f"{source}/index.html", publish_buildSourcePage(conn, source))
 
-def curtin_GetLocations():
-    curtin_url = 'https://www.curtin.edu.au/novel-coronavirus/recent-exposure-sites-on-campus/'
+    exposures = publish_latestExposures(conn)
 
+    considered += 3
+    written += publish_writeFile(manifest, "index.html", publish_buildIndexPage(conn))
+    written += publish_writeFile(manifest, "feed.json", publish_buildJsonFeed(exposures))
+    written += publish_writeFile(manifest, "atom.xml", publish_buildAtomFeed(exposures))
 
-    req = requests.get(curtin_url)
+    atomicWrite(manifest_path, (json.dumps(manifest, indent=2, sort_keys=True) + "\n").encode("utf-8"))
 
-    if req.status_code != 200:
-        print(f"Failed to fetch page: {req.reason}")
-        raise Exception("reqest_not_ok")
+    print(f"Published {written} of {considered} pages")
 
-    doc = lxml.html.fromstring(req.content)
 
-    table = doc.xpath('//table[@id="table_1"]')[0]
-    rows = table.xpath('.//tr')
 
-    header = rows.pop(0)
+def api_openReadOnly(db_file):
 
-    outRows = []
+    # open read-only so the API can never take a write lock away from a run
+    uri = pathlib.Path(db_file).resolve().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = ON;")
 
-    for row in rows:
-        record = {}
+    return conn
 
-        record['date'] = html_cleanString(row[0].text_content().strip())
-        record['time'] = html_cleanString(row[1].text_content().strip())
-        record['campus'] = html_cleanString(row[2].text_content().strip())
-        record['location'] = html_cleanString(row[3].text_content().strip())
-        record['contact_type'] = html_cleanString(row[4].text_content().strip())
-        record['last_seen'] = unix_timestamp
-
-        query = """SELECT count(id), coalesce(id, 0) FROM curtin_exposures WHERE
-                    date = ?
-                    AND time = ?
-                    AND campus = ?
-                    AND location = ?
-                    AND contact_type = ?;"""
-        
-        args = (record['date'], record['time'], record['campus'], record['location'], record['contact_type'])
-        result = dbconn.execute(query, args)
 
-        id = result.fetchone()
-        if id[0] > 0:
-            record['id'] = id[1]
+def api_tables(conn):
+    result = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")
+    tables = [row[0] for row in result.fetchall()]
+
+    return [source for source in exposure_sources if f"{source}_exposures" in tables]
+
+
+def api_intParam(params, name, default, minimum=None):
+    try:
+        value = int(params.get(name, [default])[0])
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+
+    return value
+
+
+def api_limitParam(params):
+    # sqlite treats a negative LIMIT as no limit at all, so keep it in range
+    return max(1, min(api_intParam(params, 'limit', apiMaxResults), apiMaxResults))
+
+
+def api_exposure(source, row):
+    row['source'] = source
+
+    return row
+
+
+def api_newExposures(conn, params):
+    since = api_intParam(params, 'since', 0)
+    limit = api_limitParam(params)
+
+    exposures = []
+    for source in api_tables(conn):
+        query = f"SELECT * FROM {source}_exposures WHERE first_seen > ? ORDER BY first_seen, id LIMIT ?;"
+        exposures += [api_exposure(source, row) for row in fetch_dicts(conn, query, (since, limit))]
+
+    exposures.sort(key=lambda row: (row['first_seen'], row['source'], row['id']))
+
+    return {"since": since, "exposures": exposures[:limit]}
+
+
+def api_sources(conn, params):
+    sources = []
+
+    for source in api_tables(conn):
+        query = f"SELECT count(id), coalesce(max(first_seen), 0), coalesce(max(last_seen), 0) FROM {source}_exposures;"
+        total, newest, last_seen = conn.execute(query).fetchone()
+
+        sources.append({
+            "source": source,
+            "title": exposure_sources[source]['title'],
+            "total": total,
+            "newest_first_seen": newest,
+            "last_seen": last_seen,
+        })
+
+    return {"sources": sources}
+
+
+def api_sourceExposures(conn, params, source):
+    limit = api_limitParam(params)
+    offset = api_intParam(params, 'offset', 0, minimum=0)
+
+    if params.get('listed', ['0'])[0] == '1':
+        query = f"""SELECT * FROM {source}_exposures WHERE
+                    removed_at IS NULL
+                    ORDER BY first_seen DESC, id DESC LIMIT ? OFFSET ?;"""
+    else:
+        query = f"SELECT * FROM {source}_exposures ORDER BY first_seen DESC, id DESC LIMIT ? OFFSET ?;"
+
+    exposures = [api_exposure(source, row) for row in fetch_dicts(conn, query, (limit, offset))]
+
+    return {"source": source, "limit": limit, "offset": offset, "exposures": exposures}
+
+
+def api_search(conn, params):
+    terms = params.get('q', [''])[0].strip()
+    limit = api_limitParam(params)
+
+    if len(terms) < 2:
+        raise ValueError("q must be at least 2 characters")
+
+    pattern = "%" + terms.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    sources = params.get('source', api_tables(conn))
+
+    exposures = []
+    for source in api_tables(conn):
+        if source not in sources:
+            continue
+
+        fields = exposure_sources[source]['fields']
+        where = " OR ".join(f"{field} LIKE ? ESCAPE '\\'" for field in fields)
+        query = f"SELECT * FROM {source}_exposures WHERE {where} ORDER BY first_seen DESC, id DESC LIMIT ?;"
+        args = tuple(pattern for field in fields) + (limit,)
+
+        exposures += [api_exposure(source, row) for row in fetch_dicts(conn, query, args)]
+
+    exposures.sort(key=lambda row: (row['first_seen'], row['source'], row['id']), reverse=True)
+
+    return {"q": terms, "exposures": exposures[:limit]}
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+
+    # set up by serveApi
+    conn = None
+    lock = None
+    cache = None
+
+    def route(self, url, params):
+        parts = [part for part in url.path.split("/") if part]
+
+        if parts == ["exposures"]:
+            return api_newExposures(self.conn, params)
+        if parts == ["sources"]:
+            return api_sources(self.conn, params)
+        if len(parts) == 2 and parts[0] == "sources" and parts[1] in api_tables(self.conn):
+            return api_sourceExposures(self.conn, params, parts[1])
+        if parts == ["search"]:
+            return api_search(self.conn, params)
+
+        return None
+
+    def respond(self, status, body=b"", etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+
+        with self.lock:
+            # data_version only changes when another connection (ie. a run)
+            # commits, so cached responses stay valid until then
+            data_version = self.conn.execute("PRAGMA data_version;").fetchone()[0]
+            key = (data_version, self.path)
+            cached = self.cache.get(key)
+
+            if cached is None:
+                try:
+                    response = self.route(url, params)
+                except ValueError as e:
+                    response = {"error": str(e)}
+                    status = 400
+                else:
+                    status = 200 if response is not None else 404
+                    response = response if response is not None else {"error": "not found"}
+
+                body = (json.dumps(response, sort_keys=True) + "\n").encode("utf-8")
+                etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+                cached = (status, etag, body)
+
+                if status == 200:
+                    if len(self.cache) >= apiCacheEntries:
+                        self.cache.clear()
+                    self.cache[key] = cached
+
+        status, etag, body = cached
+
+        if status != 200:
+            self.respond(status, body)
+        elif etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.respond(304, etag=etag)
         else:
-            record['id'] = None
-            record['first_seen'] = unix_timestamp
+            self.respond(200, body, etag)
 
-        outRows.append(record)
 
+def serveApi(host, port):
 
-    if (header[0].text_content().strip() == 'Date' and
-        header[1].text_content().strip() == 'Time' and
-        header[2].text_content().strip() == 'Campus' and 
-        header[3].text_content().strip() == 'Location' and 
-        header[4].text_content().strip() == 'Contact type'):
+    if not os.path.exists(db_file):
+        print(f"Database {db_file} does not exist, run a collection first")
+        exit(1)
+
+    ApiRequestHandler.conn = api_openReadOnly(db_file)
+    ApiRequestHandler.lock = threading.Lock()
+    ApiRequestHandler.cache = {}
+
+    server = ThreadingHTTPServer((host, port), ApiRequestHandler)
+    print(f"Serving {db_file} on http://{host}:{port}/")
 
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
         pass
-    else:
-        raise Exception("Curtin Failed - Parsing page failure")
 
-    return outRows
 
+def replay_snapshotTime(filename):
 
-def curtin_buildDetails(exposure):
-    exposure_details = f"""Date: {exposure['date']}
-Time: {exposure['time']}
-Campus: {exposure['campus']}
-Location: {exposure['location']}
-Contact Type: {exposure['contact_type']}\n\n"""
-    
-    return exposure_details
+    # snapshots are named after when they were taken, either as a unix
+    # timestamp or as YYYYMMDDTHHMMSS (or with any punctuation) in Perth time
+    stamp = os.path.splitext(filename)[0]
+    digits = re.sub(r"\D", "", stamp)
 
+    if len(digits) == 14:
+        taken = datetime.strptime(digits, "%Y%m%d%H%M%S")
+        return int(pytz.timezone("Australia/Perth").localize(taken).timestamp())
 
+    return int(stamp)
 
-# load sqlite3
-dbconn = create_connection(db_file)
 
-# backup db incase things go bad
-shutil.copy(db_file, f"{db_file}.bak")
+def replay_findSnapshots(directory):
 
+    snapshots = []
 
+    for source in exposure_sources:
+        source_dir = os.path.join(directory, source)
+        if not os.path.isdir(source_dir):
+            continue
 
-# get exposures
-try:
-    wahealth_exposures = wahealth_GetLocations()
-    #sheet_exposures = sheet_GetLocations()
-    sheet_exposures = []
-    ecu_exposures = ecu_GetLocations()
-    uwa_exposures = uwa_GetLocations()
-    curtin_exposures = curtin_GetLocations()
-    murdoch_exposures = murdoch_GetLocations()
-except Exception as e:
-    print(e)
-    traceback.print_stack()
-    sendAdminAlert("Unable to fetch data, please investigate")
-    exit()
-
-# clean exposures list and check if they've already been seen
-wahealth_alerts = wahealth_filterExposures(wahealth_exposures)
-
-# for each new exposure add it to the DB and add it to a string for comms
-
-wahealth_comms = ""
-sheet_comms = ""
-ecu_comms = ""
-uwa_comms = ""
-murdoch_comms = ""
-curtin_comms = ""
-
-
-for exposure in wahealth_alerts:
-
-    if exposure['id'] is None:
-        wahealth_comms = wahealth_comms + wahealth_buildDetails(exposure)
-
-        query = f"""INSERT INTO wahealth_exposures (datentime, suburb, location, updated, advice, first_seen, last_seen) 
-                    VALUES (?,?,?,?,?,?,?) """
-
-        args = (exposure['datentime'], exposure['suburb'], exposure['location'], exposure['updated'], exposure['advice'], exposure['first_seen'], exposure['last_seen'])
-        result = dbconn.execute(query, args)
-    
-    else:
-        query = f"""UPDATE wahealth_exposures SET last_seen = ? 
-                    WHERE id = ? """
+        for filename in os.listdir(source_dir):
+            try:
+                seen_at = replay_snapshotTime(filename)
+            except ValueError:
+                print(f"Skipping {source}/{filename}, unable to tell when it was taken")
+                continue
 
-        args = (exposure['last_seen'], exposure['id'])
-        result = dbconn.execute(query, args)
+            snapshots.append((seen_at, source, os.path.join(source_dir, filename)))
 
-    #if debug and len(wahealth_comms) > 0:
-    #    print(wahealth_comms)
+    snapshots.sort()
 
-for exposure in sheet_exposures:
+    return snapshots
 
-    if exposure['id'] is None:
-        sheet_comms = sheet_comms + sheet_buildDetails(exposure)
 
-        query = f"""INSERT INTO sheet_exposures (datentime, suburb, location, first_seen, last_seen) 
-                    VALUES (?,?,?,?,?) """
+def replay_findArchivedSnapshots():
 
-        args = (exposure['datentime'], exposure['suburb'], exposure['location'], exposure['first_seen'], exposure['last_seen'])
-        result = dbconn.execute(query, args)
-    
-    else:
-        query = f"""UPDATE sheet_exposures SET last_seen = ? 
-                    WHERE id = ? """
+    conn = sqlite3.connect(db_file)
+    query = "SELECT fetched_at, source, hash FROM page_archive WHERE status = 200 ORDER BY fetched_at, id;"
 
-        args = (exposure['last_seen'], exposure['id'])
-        result = dbconn.execute(query, args)
+    snapshots = []
+    for seen_at, source, digest in conn.execute(query):
+        path = archive_findBlob(archiveDir, digest)
+        if path is None:
+            print(f"Skipping {source} page fetched at {seen_at}, it's no longer in the archive")
+            continue
 
-    #if debug and len(sheet_comms) > 0:
-    #    print(sheet_comms)
+        snapshots.append((seen_at, source, path))
 
-for exposure in ecu_exposures:
+    conn.close()
 
-    if exposure['id'] is None:
-        ecu_comms = ecu_comms + ecu_buildDetails(exposure)
+    return snapshots
 
-        query = f"""INSERT INTO ecu_exposures (date, time, campus, building, room, first_seen, last_seen) 
-                    VALUES (?,?,?,?,?,?,?) """
 
-        args = (exposure['date'], exposure['time'], exposure['campus'], exposure['building'], exposure['room'], exposure['first_seen'], exposure['last_seen'])
-        result = dbconn.execute(query, args)
-    
-    else:
-        query = f"""UPDATE ecu_exposures SET last_seen = ? 
-                    WHERE id = ? """
+def replay_parseSnapshot(snapshot):
 
-        args = (exposure['last_seen'], exposure['id'])
-        result = dbconn.execute(query, args)
+    # runs in a worker process, so no DB access in here
+    seen_at, source, path = snapshot
 
-    #if debug and len(ecu_comms) > 0:
-    #    print(ecu_comms)
+    try:
+        if path.endswith((".gz", ".zst")):
+            content = readArchivedPage(path)
+        else:
+            with open(path, "rb") as f:
+                content = f.read()
 
-for exposure in uwa_exposures:
+        return exposure_sources[source]['parse'](content), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
 
-    if exposure['id'] is None:
-        uwa_comms = uwa_comms + uwa_buildDetails(exposure)
 
-        query = f"""INSERT INTO uwa_exposures (date, time, location, first_seen, last_seen) 
-                    VALUES (?,?,?,?,?) """
+def replay(directory, workers):
+    global dbconn, run_lock
 
-        args = (exposure['date'], exposure['time'], exposure['location'], exposure['first_seen'], exposure['last_seen'])
-        result = dbconn.execute(query, args)
-    
+    run_lock = acquireRunLock(f"{db_file}.lock")
+    if run_lock is None:
+        print("Another run is still in progress, exiting")
+        exit()
+
+    if directory is None:
+        snapshots = replay_findArchivedSnapshots()
+        print(f"Replaying {len(snapshots)} pages from {archiveDir}")
     else:
-        query = f"""UPDATE uwa_exposures SET last_seen = ? 
-                    WHERE id = ? """
+        snapshots = replay_findSnapshots(directory)
+        print(f"Replaying {len(snapshots)} snapshots from {directory}")
 
-        args = (exposure['last_seen'], exposure['id'])
-        result = dbconn.execute(query, args)
+    # spawn rather than fork the workers, so they don't inherit the DB connection
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
 
-    #if debug and len(uwa_comms) > 0:
-    #    print(uwa_comms)
+    dbconn = create_connection(db_file)
+    create_backup(dbconn, f"{db_file}.bak")
 
-for exposure in murdoch_exposures:
+    started = time.monotonic()
+    applied = 0
+    failed = 0
+    new = 0
 
-    if exposure['id'] is None:
-        murdoch_comms = murdoch_comms + murdoch_buildDetails(exposure)
+    # snapshots are parsed in parallel but come back in timestamp order, so
+    # they're applied in the same order they would have been seen live. Nothing
+    # is sent, this only rebuilds the DB.
+    dbconn.execute("BEGIN;")
 
-        query = f"""INSERT INTO murdoch_exposures (date, time, campus, location, first_seen, last_seen) 
-                    VALUES (?,?,?,?,?,?) """
+    with executor:
+        results = executor.map(replay_parseSnapshot, snapshots, chunksize=16)
 
-        args = (exposure['date'], exposure['time'], exposure['campus'], exposure['location'], exposure['first_seen'], exposure['last_seen'])
-        result = dbconn.execute(query, args)
-    
-    else:
-        query = f"""UPDATE murdoch_exposures SET last_seen = ? 
-                    WHERE id = ? """
+        for (seen_at, source, path), (exposures, error) in zip(snapshots, results):
 
-        args = (exposure['last_seen'], exposure['id'])
-        result = dbconn.execute(query, args)
+            if error is not None:
+                print(f"Unable to parse {path}: {error}")
+                failed += 1
+                continue
 
-    #if debug and len(murdoch_comms) > 0:
-    #    print(murdoch_comms)
+            events = ingestExposures(source, filterExposures(source, exposures, seen_at), seen_at)
+            new += len(events['new'])
+            applied += 1
 
-for exposure in curtin_exposures:
+            if applied % 100 == 0:
+                dbconn.execute("COMMIT;")
+                dbconn.execute("BEGIN;")
+                print(f"Applied {applied} of {len(snapshots)} snapshots")
 
-    if exposure['id'] is None:
-        curtin_comms = curtin_comms + curtin_buildDetails(exposure)
+    dbconn.execute("COMMIT;")
+    os.remove(f"{db_file}.bak")
 
-        query = f"""INSERT INTO curtin_exposures (date, time, campus, location, contact_type, first_seen, last_seen) 
-                    VALUES (?,?,?,?,?,?,?) """
+    print(f"Applied {applied} snapshots ({failed} failed to parse) with {new} new exposures in {time.monotonic() - started:.1f}s")
 
-        args = (exposure['date'], exposure['time'], exposure['campus'], exposure['location'], exposure['contact_type'], exposure['first_seen'], exposure['last_seen'])
-        result = dbconn.execute(query, args)
-    
+
+def run():
+    global dbconn, run_lock, page_archiver
+
+    # make sure we're the only run going, a dry run writes nothing so it can
+    # go alongside a real one
+    if dry_run is None:
+        run_lock = acquireRunLock(f"{db_file}.lock")
+        if run_lock is None:
+            print("Another run is still in progress, exiting")
+            exit()
+
+    run_budget.start()
+
+    if dry_run is not None:
+        # load sqlite3 into memory, every write the run makes stays there
+        dbconn = create_connection(db_file, overlay=True)
     else:
-        query = f"""UPDATE curtin_exposures SET last_seen = ? 
-                    WHERE id = ? """
+        # load sqlite3
+        dbconn = create_connection(db_file)
+
+        # backup db incase things go bad
+        create_backup(dbconn, f"{db_file}.bak")
+
+    if archivePages and dry_run is None:
+        page_archiver = PageArchiver(dbconn, archiveDir)
+
+    # get exposures, each source on its own so one broken page doesn't stop
+    # the rest from being processed
+    run_budget.begin('fetch')
+    source_exposures = {}
+
+    for source in exposure_sources:
+
+        if source in disabledSources:
+            continue
+
+        health = source_health(dbconn, source)
+        if not source_shouldAttempt(health):
+            print(f"Skipping {source} after {health['consecutive_failures']} failures until {health['next_attempt']}")
+            continue
+
+        try:
+            with profileStage(f"get:{source}"):
+                source_exposures[source] = exposure_sources[source]['get']()
+        except BudgetExceeded as e:
+            # a slow run isn't the source's fault, the rest can try again next run
+            print(e)
+            break
+        except Exception as e:
+            traceback.print_exc()
+            source_recordFailure(dbconn, source, e)
+            adminAlert(source, type(e).__name__, str(e), traceback.format_exc())
+        else:
+            source_recordSuccess(dbconn, source)
+            adminAlert_recovered(source)
+
+    # clean exposures lists and add them to the DB
+    run_budget.begin('ingest')
+    source_events = {}
 
-        args = (exposure['last_seen'], exposure['id'])
-        result = dbconn.execute(query, args)
+    for source, exposures in source_exposures.items():
+        source_events[source] = ingestExposures(source, exposures)
 
-    #if debug and len(curtin_comms) > 0:
-    #    print(curtin_comms)
+    if detectDuplicates:
+        mergeDuplicates(dbconn, source_events, findDuplicates(dbconn, source_events))
 
+    # Build report
 
-# Build report
+    comms = ""
 
-comms = ""
+    with profileStage("report"):
+        for source, events in source_events.items():
+            comms = comms + buildReport(source, events)
 
-if(len(wahealth_comms) > 0):
-    comms = comms + "*WA Health Exposure Sites*\n\n" + wahealth_comms + "\n\n"
+    personal = []
+    if radiusAlerts:
+        personal = subscriberAlerts(dbconn, source_events)
 
-if(len(sheet_comms) > 0):
-    comms = comms + "*Unofficial Civilian Compiled Exposure Sites*\n\n" + sheet_comms + "\n\n"
+    if dry_run is not None:
+        previewAlerts(comms, personal)
+        flushAdminAlerts(dbconn)
+        dbconn.close()
+        return
 
-if(len(ecu_comms) > 0):
-    comms = comms + "*Edith Cowan University Exposure Sites*\n\n" + ecu_comms + "\n\n"
+    if debug and len(comms) > 0:
+        print(comms)
 
-if(len(uwa_comms) > 0):
-    comms = comms + "*University of Western Australia Exposure Sites*\n\n" + uwa_comms + "\n\n"
+    run_budget.begin('notify')
 
-if(len(murdoch_comms) > 0):
-    comms = comms + "*Murdoch University Exposure Sites*\n\n" + murdoch_comms + "\n\n"
+    # kludge ugh
+    mailPostSuccess = 200
+    mailPostError = None
+    if not debug:
+        with profileStage("deliver"):
+            results = deliverAlerts(comms, personal)
 
-if(len(curtin_comms) > 0):
-    comms = comms + "*Curtin University Exposure Sites*\n\n" + curtin_comms + "\n\n"
+        for result in results:
+            if result['channel'] == 'dreamhost' and result['pending_id'] is None and result['status'] == 'failed':
+                mailPostSuccess = None
+                mailPostError = result['error']
 
-if debug and len(comms) > 0:
-    print(comms)
+    dbconn.commit()
 
-# kludge ugh
-mailPostSuccess = 200
-if not debug:
- if len(comms) > 0 and dreamhostAnounces:
-     mailPostSuccess = sendDhAnnounce(comms)
- if len(comms) > 0 and emailAlerts:
-     sendEmails(comms)
- if len(comms) > 0 and slackAlerts:
-     post_message_to_slack(comms)
- if len(comms) > 0 and discordAlerts:
-     post_message_to_discord(comms)
+    # we don't close as we're using autocommit, this results in greater 
+    # compatability with different versions of sqlite3
 
-dbconn.commit()
+    if len(comms) > 0 and dreamhostAnounces and mailPostSuccess != 200 and not debug:
+        # what was delivered, how each source fared and the pages fetched
+        # really happened, so keep them. Only the exposures are rolled back,
+        # and this run's alerts will be built again from them by the next run.
+        restore_backup(dbconn, f"{db_file}.bak", keep=['pending_deliveries', 'delivery_log', 'source_health', 'page_archive'])
+        dbconn.execute("DELETE FROM pending_deliveries WHERE created = ?;", (unix_timestamp,))
+        adminAlert('dreamhost', "DeliveryFailed", "Unable to send mail, the run has been rolled back", mailPostError or "")
+    else:
+        os.remove(f"{db_file}.bak")
+
+        if len(comms) > 0 and dreamhostAnounces and not debug:
+            adminAlert_recovered('dreamhost')
+
+        if publishSite and not debug:
+            run_budget.begin('publish')
+            with profileStage("publish"):
+                publishStaticSite(dbconn, list(source_exposures))
+
+    if page_archiver is not None:
+        with profileStage("archive"):
+            page_archiver.close()
+            pruneArchive(dbconn, archiveDir)
+
+    flushAdminAlerts(dbconn)
+
+    recordRunMetrics(dbconn)
+
+
+def main():
+    global profiler, dry_run, db_file
+
+    parser = argparse.ArgumentParser(description="Collects WA Covid-19 exposure sites and sends alerts")
+    parser.add_argument("mode", nargs="?", default="run", choices=["run", "serve", "replay", "subscribe", "unsubscribe"],
+                        help="run a collection (default), serve the read-only query API, replay archived snapshots or manage radius subscriptions")
+    parser.add_argument("directory", nargs="?",
+                        help="for replay, a directory with a sub-directory of timestamped snapshots for each source")
+    parser.add_argument("--from-archive", action="store_true", help="replay the pages in the page archive")
+    parser.add_argument("--host", default=apiHost, help="address for the query API to listen on")
+    parser.add_argument("--port", type=int, default=apiPort, help="port for the query API to listen on")
+    parser.add_argument("--workers", type=int, default=replayWorkers, help="number of processes to parse snapshots with")
+    parser.add_argument("--email", help="address to subscribe or unsubscribe")
+    parser.add_argument("--near", help="place to subscribe to, a suburb or campus in the gazetteer or \"lat,lon\"")
+    parser.add_argument("--radius", type=float, default=defaultRadius, help="distance in km from the place to subscribe to")
+    parser.add_argument("--dry-run", nargs="?", const="-", metavar="FILE",
+                        help="run against an in-memory copy of the live database without sending anything, writing the digest that would be sent to FILE (default stdout)")
+    parser.add_argument("--profile", metavar="DIRECTORY",
+                        help="profile each stage of a run, writing pstats, tracemalloc snapshots, collapsed stacks and a summary to DIRECTORY")
+    args = parser.parse_args()
+
+    if args.mode == "replay" and (args.directory is None) == (not args.from_archive):
+        parser.error("replay needs either a snapshot directory or --from-archive")
+
+    if args.mode in ["subscribe", "unsubscribe"] and args.email is None:
+        parser.error(f"{args.mode} needs --email")
+
+    if args.mode == "subscribe" and args.near is None:
+        parser.error("subscribe needs --near")
+
+    if args.dry_run is not None and args.mode != "run":
+        parser.error("--dry-run can only be used for a run")
+
+    if args.dry_run is not None:
+        dry_run = args.dry_run
+        db_file = live_db_file
+
+    if args.mode == "serve":
+        serveApi(args.host, args.port)
+    elif args.mode == "replay":
+        replay(args.directory, args.workers)
+    elif args.mode == "subscribe":
+        subscribe(args.email, args.near, args.radius)
+    elif args.mode == "unsubscribe":
+        unsubscribe(args.email)
+    elif args.profile is not None:
+        profiler = StageProfiler(args.profile)
+
+        try:
+            run()
+        finally:
+            profiler.finish()
+    else:
+        run()
 
-# we don't close as we're using autocommit, this results in greater 
-# compatability with different versions of sqlite3
 
-if len(comms) > 0 and dreamhostAnounces and mailPostSuccess != 200 and not debug:
- print(result)
- os.replace(f"{db_file}.bak", db_file)
- sendAdminAlert("Unable to send mail, please investigate")
-else:
- os.remove(f"{db_file}.bak")
+if __name__ == "__main__":
+    main()